@@ -1,18 +1,57 @@
+import time
+
+# Measure cold-start time from the very first line of the module
+_boot_started = time.perf_counter()
+
+import io
 import os
+import sys
+import gzip
+import json
+import base64
+import binascii
+import hashlib
 import logging
+import threading
 import uuid
-from flask import Flask, render_template, request, jsonify, session
-import google.generativeai as genai
-from datetime import datetime
-from models import db, Conversation, Message
+import click
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from flask import Flask, render_template, request, jsonify, session, g, Response, stream_with_context
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, delete, select, update
+from werkzeug.http import is_resource_modified
+from models import db, upgrade_schema, Conversation, Message
+from concurrency import LLMConcurrencyLimiter
+from llm import create_backend, GeminiBackend, LazyBackend
+from resilience import ResilientBackend, CircuitBreaker, DegradedText
+from cache import ResponseCache
+from sessions import create_session_interface
+from writebehind import WriteBehindWriter
+from singleflight import SingleFlight, SharedFlightTable
+from rendering import render_markdown, stored_html
+from search import search_messages, has_search_index
+from ratelimit import RateLimiter, BucketLimit, MemoryBucketStore, DatabaseBucketStore
+from transfer import export_lines, gzip_chunks, ConversationImporter, ImportValidationError
+from retention import RetentionPolicy, ConversationArchiver, purge_expired_rows, compact_database
+from metrics import MetricsRegistry, TOKEN_BUCKETS
+from context import estimate_tokens, truncate_to_tokens, select_context, format_transcript, build_summary_prompt
+
+# Configure logging; LOG_LEVEL=DEBUG adds per-request debug output, too costly for production
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+startup_timings = {'imports_ms': (time.perf_counter() - _boot_started) * 1000}
 
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "default_secret_key")
 
+# Keep session data server-side; the cookie only carries a session ID
+app.permanent_session_lifetime = timedelta(days=int(os.environ.get("SESSION_LIFETIME_DAYS", 30)))
+session_interface = create_session_interface(app)
+if session_interface:
+    app.session_interface = session_interface
+
 # Configure the database
 database_url = os.environ.get("DATABASE_URL")
 if not database_url:
@@ -24,22 +63,13 @@ app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db.init_app(app)
 
-# Initialize Google Gemini API
-GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-genai.configure(api_key=GOOGLE_API_KEY)
-
-# Create database tables
-with app.app_context():
-    db.create_all()
-
-# Log available models for debugging
-try:
-    available_models = genai.list_models()
-    logging.info("Available models:")
-    for model_info in available_models:
-        logging.info(f"- {model_info.name}")
-except Exception as e:
-    logging.error(f"Error listing models: {str(e)}")
+# Schema changes are applied with `flask --app app init-db` (the Procfile release step),
+# not on every worker boot. SCHEMA_AUTO_UPGRADE=true applies them at import instead.
+_db_started = time.perf_counter()
+if os.environ.get("SCHEMA_AUTO_UPGRADE", "false").lower() == "true":
+    with app.app_context():
+        upgrade_schema()
+startup_timings['database_ms'] = (time.perf_counter() - _db_started) * 1000
 
 # Configure the model with better parameters for educational responses
 generation_config = {
@@ -49,12 +79,196 @@ generation_config = {
     "max_output_tokens": 4096,  # Increased for more comprehensive answers
 }
 
-# Use the correct model name format based on available models
-model = genai.GenerativeModel(
-    model_name="models/gemini-1.5-pro",  # Confirmed available model
-    generation_config=generation_config
+def create_llm():
+    """Create the LLM backend with the per-persona and per-action system prompts registered
+
+    Calls go through a ResilientBackend: every call has a deadline, transient errors
+    are retried with jittered backoff, a circuit breaker fails fast while the model is
+    failing, and with LLM_FALLBACK=true a faster model answers when the primary one is
+    too slow or down. LLM_HEDGE=true sends a second request when the first is slower
+    than LLM_HEDGE_DELAY seconds (by default the recent p95 latency).
+    """
+    hedge_delay = os.environ.get("LLM_HEDGE_DELAY")
+    backend = ResilientBackend(
+        create_backend(generation_config),
+        fallback=create_backend(generation_config, fallback=True)
+            if os.environ.get("LLM_FALLBACK", "false").lower() == "true" else None,
+        deadline=float(os.environ.get("LLM_DEADLINE", 60)),
+        attempt_timeout=float(os.environ.get("LLM_ATTEMPT_TIMEOUT", 30)),
+        retries=int(os.environ.get("LLM_RETRIES", 2)),
+        retry_base_delay=float(os.environ.get("LLM_RETRY_BASE_DELAY", 0.5)),
+        retry_max_delay=float(os.environ.get("LLM_RETRY_MAX_DELAY", 4)),
+        hedge=os.environ.get("LLM_HEDGE", "false").lower() == "true",
+        hedge_delay=float(hedge_delay) if hedge_delay else None,
+        fallback_after=float(os.environ.get("LLM_FALLBACK_AFTER", 20)),
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.environ.get("LLM_BREAKER_FAILURES", 5)),
+            cooldown=float(os.environ.get("LLM_BREAKER_COOLDOWN", 30)),
+            transition_counter=llm_breaker_transitions
+        ),
+        attempt_counter=llm_attempts
+    )
+    backend.register_system_prompts(build_system_prompts())
+    return backend
+
+# The LLM backend (Google Gemini by default, LLM_BACKEND=stub for offline use) is created
+# on first use in each worker, keeping imports fast and safe for gunicorn --preload
+llm = LazyBackend(create_llm)
+
+# Number of messages kept in the session when the database is unavailable
+SESSION_HISTORY_LIMIT = 10
+
+# Token budget for the conversation context (rolling summary plus recent messages) in a prompt
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 3000))
+# Longest a single message may be in the context before it's truncated
+CONTEXT_MAX_MESSAGE_TOKENS = int(os.environ.get("CONTEXT_MAX_MESSAGE_TOKENS", 1000))
+# Most recent unsummarized messages considered for the context
+CONTEXT_MAX_MESSAGES = 50
+# Maximum length of the rolling conversation summary
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", 500))
+
+# Default and maximum number of messages per page of /api/history
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+# Default and maximum number of results per page of /api/search
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+# Shown instead of an answer when the LLM fails; the details are only logged
+LLM_ERROR_MESSAGE = "I apologize, but I couldn't answer that right now. Please try again in a moment or rephrase your question."
+
+# How often (in seconds) a streaming response is written to the database while it's generated
+STREAM_SAVE_INTERVAL = 1.0
+
+# Limits of /api/chat/batch: items per request and seconds per item (items generated at
+# once, BATCH_MAX_CONCURRENCY, is set below from the LLM limiter)
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 50))
+BATCH_ITEM_TIMEOUT = float(os.environ.get("BATCH_ITEM_TIMEOUT", 60))
+
+# Retention of idle conversations (see `flask --app app archive-conversations`). By default a
+# conversation is kept as long as its session could still be resumed.
+RETENTION_IDLE_DAYS = int(os.environ.get("RETENTION_IDLE_DAYS", app.permanent_session_lifetime.days))
+RETENTION_SHORT_IDLE_DAYS = int(os.environ.get("RETENTION_SHORT_IDLE_DAYS", 7))
+RETENTION_SHORT_MAX_MESSAGES = int(os.environ.get("RETENTION_SHORT_MAX_MESSAGES", 2))
+RETENTION_ARCHIVE_DIR = os.environ.get("RETENTION_ARCHIVE_DIR", "archive")
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", 500))
+
+# Cache of responses to standalone persona/action prompts, optionally shared between workers
+response_cache = ResponseCache(
+    enabled=os.environ.get("RESPONSE_CACHE_ENABLED", "true").lower() == "true",
+    max_entries=int(os.environ.get("RESPONSE_CACHE_SIZE", 512)),
+    ttl=int(os.environ.get("RESPONSE_CACHE_TTL", 3600)),
+    shared=os.environ.get("RESPONSE_CACHE_SHARED", "false").lower() == "true"
 )
 
+# Cap on concurrent LLM calls per worker, with a bounded queue for requests waiting on a slot.
+# Each in-flight or waiting request occupies a gunicorn thread, so LLM_MAX_IN_FLIGHT plus
+# LLM_MAX_QUEUE must stay below GUNICORN_THREADS: otherwise the queue never fills up and
+# excess requests wait in gunicorn's backlog instead of getting a 503. By default half the
+# threads call the LLM and a quarter wait, leaving the rest for rejections and other requests.
+GUNICORN_THREADS = int(os.environ.get("GUNICORN_THREADS", 32))
+llm_limiter = LLMConcurrencyLimiter(
+    max_in_flight=int(os.environ.get("LLM_MAX_IN_FLIGHT", max(GUNICORN_THREADS // 2, 1))),
+    max_queue=int(os.environ.get("LLM_MAX_QUEUE", max(GUNICORN_THREADS // 4, 1))),
+    queue_timeout=float(os.environ.get("LLM_QUEUE_TIMEOUT", 30)),
+    retry_after=int(os.environ.get("LLM_RETRY_AFTER", 5))
+)
+# A batch takes at most a quarter of the LLM slots, so one client can't crowd out interactive chats
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", max(llm_limiter.max_in_flight // 4, 1)))
+
+# Optional write-behind persistence: new messages are queued and inserted in batches by a
+# background thread instead of being committed before each response is returned
+message_writer = WriteBehindWriter(
+    app,
+    flush_interval=float(os.environ.get("WRITE_BEHIND_INTERVAL", 0.2)),
+    batch_size=int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 500)),
+    max_pending=int(os.environ.get("WRITE_BEHIND_MAX_PENDING", 5000))
+) if os.environ.get("WRITE_BEHIND", "false").lower() == "true" else None
+
+# Per-stage latency and token metrics, exposed at /metrics. Set METRICS_DIR to a directory
+# shared by all gunicorn workers to have every scrape report the totals of all workers.
+metrics = MetricsRegistry(
+    directory=os.environ.get("METRICS_DIR") or None,
+    flush_interval=float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+)
+request_duration = metrics.histogram(
+    'edubuddy_request_duration_seconds',
+    'Time from the start of a request until its response has been sent completely',
+    ('endpoint', 'method', 'status', 'persona', 'action')
+)
+stage_duration = metrics.histogram(
+    'edubuddy_stage_duration_seconds',
+    'Time spent in each stage of a chat request (database, prompt building, LLM)',
+    ('stage', 'persona', 'action')
+)
+llm_tokens = metrics.histogram(
+    'edubuddy_llm_tokens',
+    'Estimated prompt and response tokens per LLM call',
+    ('kind', 'persona', 'action'),
+    buckets=TOKEN_BUCKETS
+)
+llm_attempts = metrics.counter(
+    'edubuddy_llm_attempts_total',
+    'LLM requests by model (primary or fallback), attempt (first, retry, hedge, fallback) and outcome',
+    ('model', 'attempt', 'outcome')
+)
+llm_breaker_transitions = metrics.counter(
+    'edubuddy_llm_circuit_transitions_total',
+    'State changes of the LLM circuit breaker, by the new state',
+    ('state',)
+)
+llm_coalesced = metrics.counter(
+    'edubuddy_llm_coalesced_total',
+    'LLM calls answered by an identical call that was already in flight',
+    ('kind', 'scope')
+)
+
+# Identical concurrent LLM calls (e.g. a double-clicked quick action) share one upstream call;
+# LLM_SINGLE_FLIGHT_SHARED=true coalesces them across workers through a lock table
+llm_flights = SingleFlight(
+    shared=SharedFlightTable(
+        ttl=int(os.environ.get("LLM_SINGLE_FLIGHT_TTL", 120)),
+        poll_interval=float(os.environ.get("LLM_SINGLE_FLIGHT_POLL_INTERVAL", 0.1))
+    ) if os.environ.get("LLM_SINGLE_FLIGHT_SHARED", "false").lower() == "true" else None,
+    coalesced_counter=llm_coalesced
+) if os.environ.get("LLM_SINGLE_FLIGHT", "true").lower() == "true" else None
+
+# Token-bucket rate limits on the endpoints that call the LLM, per session and per client IP,
+# on the number of requests and on estimated LLM tokens. RATE_LIMIT_<BUCKET> is the refill
+# per minute and RATE_LIMIT_<BUCKET>_BURST the bucket size. With RATE_LIMIT_BACKEND=database
+# all workers share the buckets; with memory each worker enforces the limits on its own.
+RATE_LIMITED_ENDPOINTS = ('chat', 'chat_stream', 'chat_batch')
+# Tokens reserved for a response until its actual size is known
+RATE_LIMIT_RESPONSE_TOKENS = int(os.environ.get("RATE_LIMIT_RESPONSE_TOKENS", 1000))
+# Number of proxies in front of the app that append to X-Forwarded-For (0: use the peer address)
+RATE_LIMIT_PROXY_HOPS = int(os.environ.get("RATE_LIMIT_PROXY_HOPS", 0))
+
+def bucket_limit(name, per_minute, burst):
+    return BucketLimit(
+        capacity=int(os.environ.get(f"RATE_LIMIT_{name.upper()}_BURST", burst)),
+        per_minute=float(os.environ.get(f"RATE_LIMIT_{name.upper()}", per_minute))
+    )
+
+rate_limited = metrics.counter(
+    'edubuddy_rate_limited_total',
+    'Requests rejected by a rate limit',
+    ('bucket',)
+)
+rate_limiter = RateLimiter(
+    store=DatabaseBucketStore() if os.environ.get("RATE_LIMIT_BACKEND", "memory").lower() == "database" else MemoryBucketStore(),
+    limits={
+        'session_requests': bucket_limit('session_requests', 10, 10),
+        'session_tokens': bucket_limit('session_tokens', 8000, 16000),
+        # A whole classroom can share one address, so the IP limits are much higher
+        'ip_requests': bucket_limit('ip_requests', 120, 120),
+        'ip_tokens': bucket_limit('ip_tokens', 100000, 200000),
+    },
+    rejected_counter=rate_limited
+) if os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true" else None
+# Guards a request's g.llm_token_usage, which the items of a batch add to from several threads
+llm_token_usage_lock = threading.Lock()
+
 # Base AI mentor system prompt with educational focus
 BASE_MENTOR_PROMPT = """You are an AI mentor specialized in quality education. You provide structured responses with step-by-step explanations, real-world analogies, and interactive learning techniques. If a question is unclear, you ask for clarification before responding.
 
@@ -152,6 +366,29 @@ ACTION_PROMPTS = {
     }
 }
 
+def set_metric_labels(persona, action=None):
+    """Label this request's metrics with its persona and (known) quick action"""
+    g.metric_labels = {
+        'persona': persona,
+        'action': action if action in ACTION_PROMPTS.get(persona, {}) else ''
+    }
+
+def metric_labels():
+    """Persona and action labels for the current request's metrics"""
+    return g.get('metric_labels') or {'persona': '', 'action': ''}
+
+def record_llm_tokens(prompt, system_prompt, response):
+    """Record the estimated prompt and response size of an LLM call"""
+    labels = metric_labels()
+    prompt_tokens = estimate_tokens(llm.system_prompts.get(system_prompt, '') + prompt)
+    response_tokens = estimate_tokens(response)
+    llm_tokens.observe(prompt_tokens, kind='prompt', **labels)
+    llm_tokens.observe(response_tokens, kind='response', **labels)
+    # Settled against the rate limiter's estimate once the response has been sent
+    if 'llm_token_usage' in g:
+        with llm_token_usage_lock:
+            g.llm_token_usage['tokens'] += prompt_tokens + response_tokens
+
 def get_or_create_session_id():
     """Get the existing session ID or create a new one"""
     if 'session_id' not in session:
@@ -159,7 +396,13 @@ def get_or_create_session_id():
     return session['session_id']
 
 def get_or_create_conversation():
-    """Get the existing conversation or create a new one"""
+    """Get the existing conversation or create a new one, loaded once per request"""
+    if 'conversation' in g:
+        # Streaming responses run in a new database session, so re-attach the row without reloading it
+        if g.conversation not in db.session:
+            g.conversation = db.session.merge(g.conversation, load=False)
+        return g.conversation
+    
     session_id = get_or_create_session_id()
     
     # Try to find the existing conversation
@@ -172,25 +415,49 @@ def get_or_create_conversation():
         db.session.commit()
         logging.info(f"Created new conversation with ID: {conversation.id}")
     
+    g.conversation = conversation
     return conversation
 
-def get_chat_history():
-    """Retrieve chat history from database"""
+def format_pending_entry(entry):
+    """A message still queued for the database, in the to_dict format"""
+    return {
+        'role': entry['role'],
+        'content': entry['content'],
+        'timestamp': entry['timestamp'].strftime("%Y-%m-%d %H:%M:%S"),
+        'html': stored_html(entry.get('html'))
+    }
+
+def get_pending_history(conversation_id):
+    """Messages of a conversation still queued for the database, in the to_dict format"""
+    if message_writer is None:
+        return []
+    return [format_pending_entry(entry) for entry in message_writer.pending(conversation_id)]
+
+def get_chat_history(limit=None, after_id=None):
+    """Retrieve chat history from database
+
+    With `limit` only the latest messages are returned, and with `after_id` only
+    messages newer than that message ID. Messages still queued by the write-behind
+    writer are included.
+    """
     try:
         # Get the conversation
         conversation = get_or_create_conversation()
         
-        # Get messages, ordered by timestamp
-        messages = Message.query.filter_by(conversation_id=conversation.id).order_by(Message.timestamp).all()
+        # Get messages, ordered by timestamp (newest first when only the latest are needed)
+        query = Message.query.filter_by(conversation_id=conversation.id)
+        if after_id:
+            query = query.filter(Message.id > after_id)
+        with stage_duration.time(stage='db_get_chat_history', **metric_labels()):
+            if limit:
+                messages = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
+                messages.reverse()
+            else:
+                messages = query.order_by(Message.timestamp, Message.id).all()
         
         # Format messages for use in the application
-        history = [message.to_dict() for message in messages]
-        
-        # If no messages exist yet, return an empty list
-        if not history:
-            return []
-            
-        return history
+        history = [message.to_dict() for message in messages] + get_pending_history(conversation.id)
+        return history[-limit:] if limit else history
     except Exception as e:
         logging.error(f"Error getting chat history: {str(e)}")
         # Rollback the session in case of error
@@ -198,7 +465,74 @@ def get_chat_history():
         # Fallback to session if database fails
         if 'chat_history' not in session:
             session['chat_history'] = []
-        return session['chat_history']
+        return session['chat_history'][-limit:] if limit else session['chat_history']
+
+def encode_history_cursor(timestamp, message_id):
+    """Opaque keyset pagination cursor for the position of a message"""
+    position = f"{timestamp.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+def decode_history_cursor(cursor):
+    """Parse a cursor from encode_history_cursor into (timestamp, id)"""
+    try:
+        timestamp, message_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError('Invalid history cursor')
+
+def get_chat_history_page(limit, before=None):
+    """Retrieve one page of chat history (oldest first) and the cursor of the next older page"""
+    try:
+        conversation = get_or_create_conversation()
+        
+        queued = message_writer.pending(conversation.id) if message_writer is not None else []
+        if before:
+            queued = [entry for entry in queued if entry['timestamp'] < before[0]]
+        pending = queued[-limit:]
+        db_limit = limit - len(pending)
+        
+        if len(queued) > len(pending):
+            # Older queued messages are left, so the page has no room for stored ones. Queued
+            # messages have no ID yet, so the cursor is the oldest one's timestamp with ID 0
+            messages = []
+            next_cursor = encode_history_cursor(pending[0]['timestamp'], 0)
+        else:
+            query = Message.query.filter_by(conversation_id=conversation.id)
+            if before:
+                timestamp, message_id = before
+                query = query.filter(or_(
+                    Message.timestamp < timestamp,
+                    and_(Message.timestamp == timestamp, Message.id < message_id)
+                ))
+            
+            # Fetch one extra message to find out whether there is an older page
+            messages = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(db_limit + 1).all()
+            next_cursor = None
+            if len(messages) > db_limit:
+                if db_limit:
+                    next_cursor = encode_history_cursor(messages[db_limit - 1].timestamp, messages[db_limit - 1].id)
+                else:
+                    next_cursor = encode_history_cursor(pending[0]['timestamp'], 0)
+            messages = messages[:db_limit]
+            messages.reverse()
+        
+        # Render answers saved without HTML (or by an older renderer) once, and keep the result
+        unrendered = [
+            message for message in messages
+            if message.role == 'assistant' and stored_html(message.content_html) is None
+        ]
+        for message in unrendered:
+            message.content_html = render_markdown(message.content)
+        if unrendered:
+            db.session.commit()
+        
+        return [message.to_dict(html=True) for message in messages] + [format_pending_entry(entry) for entry in pending], next_cursor
+    except Exception as e:
+        logging.error(f"Error getting chat history page: {str(e)}")
+        # Rollback the session in case of error
+        db.session.rollback()
+        # Fallback to session if database fails
+        return session.get('chat_history', [])[-limit:], None
 
 def get_current_persona():
     """Retrieve current persona from database or return the default"""
@@ -219,10 +553,13 @@ def set_persona(persona):
     if persona in PERSONA_PROMPTS:
         try:
             conversation = get_or_create_conversation()
-            conversation.persona = persona
-            db.session.commit()
+            # Skip the write when the persona is unchanged
+            if conversation.persona != persona:
+                conversation.persona = persona
+                db.session.commit()
             # Also update session as fallback
-            session['persona'] = persona
+            if session.get('persona') != persona:
+                session['persona'] = persona
             return True
         except Exception as e:
             logging.error(f"Error setting persona in database: {str(e)}")
@@ -239,41 +576,54 @@ def get_prompt_for_persona(persona):
         return f"{BASE_MENTOR_PROMPT}\n\n{PERSONA_PROMPTS[persona]}"
     return BASE_MENTOR_PROMPT
 
-def update_chat_history(role, content):
-    """Add a new message to the chat history in the database"""
+def new_history_entry(role, content):
+    """Create a chat history entry for a message that hasn't been saved yet"""
+    return {
+        'role': role,
+        'content': content,
+        'timestamp': datetime.utcnow()
+    }
+
+def remember_in_session(entries):
+    """Append chat history entries to the session fallback, keeping only the latest few"""
+    history = session.get('chat_history', [])
+    
+    for entry in entries:
+        history.append({
+            'role': entry['role'],
+            'content': entry['content'],
+            'timestamp': entry['timestamp'].strftime("%Y-%m-%d %H:%M:%S")
+        })
+    
+    session['chat_history'] = history[-SESSION_HISTORY_LIMIT:]
+    return session['chat_history']
+
+def update_chat_history(entries, hold_last=False):
+    """Add messages to the chat history in one transaction, or queue them in write-behind mode"""
     try:
         # Get the conversation
         conversation = get_or_create_conversation()
         
-        # Create a new message
-        message = Message(
-            conversation_id=conversation.id,
-            role=role,
-            content=content
-        )
+        if message_writer is not None:
+            return message_writer.enqueue(conversation.id, entries, hold_last=hold_last)
         
-        # Add and commit to database
-        db.session.add(message)
-        db.session.commit()
-        
-        # Update the conversation's updated_at timestamp
+        # Insert the messages and bump the conversation's updated_at in one commit
+        messages = [
+            Message(
+                conversation_id=conversation.id,
+                role=entry['role'],
+                content=entry['content'],
+                content_html=entry.get('html'),
+                timestamp=entry['timestamp']
+            )
+            for entry in entries
+        ]
+        db.session.add_all(messages)
         conversation.updated_at = datetime.utcnow()
-        db.session.commit()
-        
-        # Also update session as fallback
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        if 'chat_history' not in session:
-            session['chat_history'] = []
-            
-        session['chat_history'].append({
-            'role': role, 
-            'content': content,
-            'timestamp': timestamp
-        })
+        with stage_duration.time(stage='db_update_chat_history', **metric_labels()):
+            db.session.commit()
         
-        # Get the updated history
-        return get_chat_history()
+        return messages
         
     except Exception as e:
         logging.error(f"Error updating chat history in database: {str(e)}")
@@ -281,74 +631,342 @@ def update_chat_history(role, content):
         db.session.rollback()
         
         # Fallback to session if database fails
-        history = session.get('chat_history', [])
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        history.append({
-            'role': role, 
-            'content': content,
-            'timestamp': timestamp
-        })
-        
-        # Keep only the last 10 messages for context when using session
-        if len(history) > 10:
-            history.pop(0)
-        
-        session['chat_history'] = history
-        return history
+        remember_in_session(entries)
+        return None
+
+def load_context():
+    """Load the conversation context for a new message within the token budget
+
+    Returns the newest unsummarized messages that fit in CONTEXT_TOKEN_BUDGET together
+    with the rolling summary of everything older. When older messages have fallen out
+    of the budget or out of the last CONTEXT_MAX_MESSAGES, g.summary_due is set so
+    they get folded into the summary after the response has been sent.
+    """
+    conversation = get_or_create_conversation()
+    summary = conversation.summary
+    
+    # One message more than the window shows whether older unsummarized messages exist
+    history = get_chat_history(limit=CONTEXT_MAX_MESSAGES + 1, after_id=conversation.summary_until)
+    overflow, history = history[:-CONTEXT_MAX_MESSAGES], history[-CONTEXT_MAX_MESSAGES:]
+    budget = CONTEXT_TOKEN_BUDGET - estimate_tokens(summary or '')
+    context, older = select_context(history, budget, CONTEXT_MAX_MESSAGE_TOKENS)
+    older = overflow + older
+    
+    # Messages from the session fallback have no ID and can't be summarized
+    if older and 'id' in older[-1]:
+        g.summary_due = True
+    
+    return context, summary
+
+def update_conversation_summary(conversation_id):
+    """Fold the messages that no longer fit in the context into the rolling summary
+
+    These are the messages older than the last CONTEXT_MAX_MESSAGES, at most
+    CONTEXT_MAX_MESSAGES of them per call (the rest follow on later turns), and then
+    those of the window that don't fit in the token budget. Runs after the response
+    has been sent, outside the request context.
+    """
+    with app.app_context():
+        try:
+            conversation = db.session.get(Conversation, conversation_id)
+            if conversation is None:
+                return
+            
+            query = Message.query.filter_by(conversation_id=conversation_id)
+            if conversation.summary_until:
+                query = query.filter(Message.id > conversation.summary_until)
+            window = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(CONTEXT_MAX_MESSAGES).all()
+            window.reverse()
+            
+            # Messages before the window never make it into a prompt; the oldest go first
+            overflow = []
+            if len(window) == CONTEXT_MAX_MESSAGES:
+                first = window[0]
+                overflow = query.filter(or_(
+                    Message.timestamp < first.timestamp,
+                    and_(Message.timestamp == first.timestamp, Message.id < first.id)
+                )).order_by(Message.timestamp, Message.id).limit(CONTEXT_MAX_MESSAGES).all()
+            older = [message.to_dict() for message in overflow]
+            
+            if len(overflow) < CONTEXT_MAX_MESSAGES:
+                budget = CONTEXT_TOKEN_BUDGET - estimate_tokens(conversation.summary or '')
+                _, rejected = select_context([message.to_dict() for message in window], budget, CONTEXT_MAX_MESSAGE_TOKENS)
+                older += rejected
+            if not older:
+                return
+            
+            # Update the summary incrementally with just the messages that fell out of the context
+            prompt = build_summary_prompt(conversation.summary, older, SUMMARY_MAX_TOKENS * 3 // 4, CONTEXT_MAX_MESSAGE_TOKENS)
+            summary = truncate_to_tokens(llm.generate(prompt).strip(), SUMMARY_MAX_TOKENS)
+            
+            # Setting updated_at to itself stops onupdate from invalidating the history's ETag
+            db.session.execute(
+                update(Conversation)
+                .where(Conversation.id == conversation_id)
+                .values(summary=summary, summary_until=older[-1]['id'], updated_at=Conversation.updated_at)
+            )
+            db.session.commit()
+            logging.info(f"Summarized {len(older)} messages of conversation ID: {conversation_id}")
+        except Exception as e:
+            logging.error(f"Error updating conversation summary: {str(e)}")
+            # Rollback the session in case of error
+            db.session.rollback()
+
+def get_system_prompt_name(persona, action=None):
+    """Name of the registered system prompt for a persona and optional quick action"""
+    if persona not in PERSONA_PROMPTS:
+        return 'base'
+    if action and action in ACTION_PROMPTS.get(persona, {}):
+        return f"{persona}/{action}"
+    return persona
+
+def build_system_prompts():
+    """System instructions for every persona and persona/action combination"""
+    system_prompts = {'base': BASE_MENTOR_PROMPT}
+    for persona in PERSONA_PROMPTS:
+        persona_prompt = get_prompt_for_persona(persona)
+        system_prompts[persona] = persona_prompt
+        for action, action_instruction in ACTION_PROMPTS.get(persona, {}).items():
+            system_prompts[f"{persona}/{action}"] = f"{persona_prompt}\n\nSpecial instruction: {action_instruction}"
+    return system_prompts
+
+def build_prompt(user_message, context, persona, summary=None):
+    """Assemble the prompt for the model from context and the latest message
+
+    The persona and action instructions aren't part of it; they are sent as the
+    system instruction named by get_system_prompt_name.
+    """
+    complete_prompt = ""
+    
+    if summary:  # Summary of the conversation before the context window
+        complete_prompt += f"Summary of the earlier conversation:\n{summary}\n\n"
+    
+    if context:  # If there's conversation history
+        complete_prompt += f"Previous conversation:\n{format_transcript(context)}\n"
+    
+    complete_prompt += f"User's latest question: {user_message}\n\n"
+    complete_prompt += f"Respond as the AI Mentor with the {persona} specialization:"
+    
+    return complete_prompt
+
+def get_cache_key(user_message, context, persona, action=None, summary=None):
+    """Response cache key for a request, or None if it must bypass the cache"""
+    if action not in ACTION_PROMPTS.get(persona, {}):
+        action = None
+    
+    # Everything build_prompt includes before the latest message
+    if summary:
+        context = [{'role': 'summary', 'content': summary}] + context
+    return response_cache.key_for(persona, action, user_message, context)
+
+def get_flight_key(kind, prompt, system_prompt):
+    """Fingerprint of the final prompt, shared by identical LLM calls"""
+    fingerprint = json.dumps([kind, system_prompt or "", prompt])
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+def call_llm(prompt, system_prompt):
+    """Generate a response, sharing the call with identical ones already in flight
+
+    Returns (text, own_call): own_call is False when the text came from an identical
+    call someone else made, whose tokens are already counted in the metrics and
+    rate limits of that caller.
+    """
+    if llm_flights is None:
+        return llm.generate(prompt, system=system_prompt), True
+    own_call = threading.Event()
+    
+    def generate():
+        own_call.set()
+        return llm.generate(prompt, system=system_prompt)
+    
+    text = llm_flights.call(get_flight_key('generate', prompt, system_prompt), generate)
+    return text, own_call.is_set()
+
+def stream_llm(prompt, system_prompt):
+    """Stream a response, attaching to an identical stream already in flight
+
+    Returns (chunks, own_call): own_call is an Event that is set when this caller's
+    stream is the one made upstream, as opposed to one it attached to.
+    """
+    own_call = threading.Event()
+    if llm_flights is None:
+        own_call.set()
+        return llm.stream(prompt, system=system_prompt), own_call
+    
+    def open_stream():
+        own_call.set()
+        return llm.stream(prompt, system=system_prompt)
+    
+    return llm_flights.stream(get_flight_key('stream', prompt, system_prompt), open_stream), own_call
+
+def generate_standalone_response(user_message, persona, action=None):
+    """Generate a response to a prompt outside of any conversation, e.g. a batch item
+
+    Nothing is read from or written to the chat history. Repeated prompts are served
+    from the response cache like a conversation's first message.
+    """
+    with stage_duration.time(stage='prompt_build', **metric_labels()):
+        complete_prompt = build_prompt(user_message, [], persona)
+        system_prompt = get_system_prompt_name(persona, action)
+    
+    cache_key = get_cache_key(user_message, [], persona, action)
+    assistant_message = response_cache.get(cache_key) if cache_key else None
+    
+    if assistant_message is None:
+        with stage_duration.time(stage='llm_total', **metric_labels()):
+            assistant_message, own_call = call_llm(complete_prompt, system_prompt)
+        if own_call:
+            record_llm_tokens(complete_prompt, system_prompt, assistant_message)
+        if cache_key and not isinstance(assistant_message, DegradedText):
+            response_cache.set(cache_key, assistant_message)
+    
+    return assistant_message
 
 def generate_response(user_message, action=None):
     """Generate a response using Google Gemini and conversation history"""
+    user_entry = new_history_entry('user', user_message)
+    
     try:
-        # Update history with new user message
-        update_chat_history('user', user_message)
-        history = get_chat_history()
+        # Load the conversation context that fits in the token budget
+        context, summary = load_context()
         
         # Get the current persona
         persona = get_current_persona()
         
-        # Format conversation history for the model
-        formatted_history = ""
+        # Build the prompt from context and the new message; persona and action go in the system prompt
+        with stage_duration.time(stage='prompt_build', **metric_labels()):
+            complete_prompt = build_prompt(user_message, context, persona, summary)
+            system_prompt = get_system_prompt_name(persona, action)
         
-        # Add previous conversation context (only include the last 5 turns)
-        recent_history = history[-5:] if len(history) > 5 else history
-        for msg in recent_history:
-            if msg['role'] == 'user':
-                formatted_history += f"User: {msg['content']}\n\n"
-            else:  # assistant
-                formatted_history += f"AI Mentor: {msg['content']}\n\n"
+        # Serve repeated standalone prompts from the response cache
+        cache_key = get_cache_key(user_message, context, persona, action, summary)
+        assistant_message = response_cache.get(cache_key) if cache_key else None
         
-        # Get the appropriate prompt for the persona
-        persona_prompt = get_prompt_for_persona(persona)
+        if assistant_message is None:
+            # Generate the response
+            with stage_duration.time(stage='llm_total', **metric_labels()):
+                assistant_message, own_call = call_llm(complete_prompt, system_prompt)
+            if own_call:
+                record_llm_tokens(complete_prompt, system_prompt, assistant_message)
+            # Answers of the fallback model aren't cached, so the next ask gets the full model
+            if cache_key and not isinstance(assistant_message, DegradedText):
+                response_cache.set(cache_key, assistant_message)
         
-        # Create the complete prompt with system instructions, history and current user message
-        complete_prompt = f"{persona_prompt}\n\n"
+        # Render the answer's Markdown once, for this response and the stored history
+        assistant_entry = new_history_entry('assistant', assistant_message)
+        assistant_entry['html'] = g.response_html = render_markdown(assistant_message)
         
-        if len(history) > 1:  # If there's conversation history
-            complete_prompt += f"Previous conversation:\n{formatted_history}\n"
-        
-        # Add action-specific instructions if applicable
-        if action and persona in ACTION_PROMPTS and action in ACTION_PROMPTS[persona]:
-            action_instruction = ACTION_PROMPTS[persona][action]
-            complete_prompt += f"User's latest question: {user_message}\n\n"
-            complete_prompt += f"Special instruction: {action_instruction}\n\n"
-        else:
-            complete_prompt += f"User's latest question: {user_message}\n\n"
-        
-        complete_prompt += f"Respond as the AI Mentor with the {persona} specialization:"
-        
-        # Generate the response
-        response = model.generate_content(complete_prompt)
-        assistant_message = response.text
-        
-        # Update history with assistant's response
-        update_chat_history('assistant', assistant_message)
+        # Save the user message and the assistant's response together
+        update_chat_history([user_entry, assistant_entry])
         
         return assistant_message
         
     except Exception as e:
         logging.error(f"Error generating response: {str(e)}")
-        return f"I apologize, but I encountered an error while processing your request. Please try again or rephrase your question. Error details: {str(e)}"
+        # Keep the user's message even though there is no answer to it
+        update_chat_history([user_entry])
+        return LLM_ERROR_MESSAGE
+
+def save_streamed_message(message, content, html=None):
+    """Update the assistant message row for a response that is still streaming
+
+    Pass the rendered html with the final content; partial answers are saved without it.
+    """
+    try:
+        message.content = content
+        message.content_html = html
+        get_or_create_conversation().updated_at = datetime.utcnow()
+        with stage_duration.time(stage='db_save_streamed_message', **metric_labels()):
+            db.session.commit()
+    except Exception as e:
+        logging.error(f"Error saving streamed message: {str(e)}")
+        # Rollback the session in case of error
+        db.session.rollback()
+
+def generate_response_stream(user_message, action=None):
+    """Yield a response from Google Gemini chunk by chunk, persisting it as it arrives"""
+    user_entry = new_history_entry('user', user_message)
+    
+    # Load the conversation context that fits in the token budget
+    context, summary = load_context()
+    
+    # Get the current persona and build the prompt; persona and action go in the system prompt
+    persona = get_current_persona()
+    with stage_duration.time(stage='prompt_build', **metric_labels()):
+        complete_prompt = build_prompt(user_message, context, persona, summary)
+        system_prompt = get_system_prompt_name(persona, action)
+    
+    # A cached response is sent as a single chunk
+    cache_key = get_cache_key(user_message, context, persona, action, summary)
+    cached_message = response_cache.get(cache_key) if cache_key else None
+    if cached_message is not None:
+        stream, own_call = iter([cached_message]), None
+    else:
+        stream, own_call = stream_llm(complete_prompt, system_prompt)
+    
+    chunks = []
+    assistant_entry = None
+    message = None
+    last_saved = time.monotonic()
+    completed = False
+    llm_started = time.perf_counter()
+    
+    try:
+        for text in stream:
+            if not chunks and cached_message is None:
+                stage_duration.observe(time.perf_counter() - llm_started, stage='llm_first_token', **metric_labels())
+            chunks.append(text)
+            yield text
+            
+            # Save the user message together with the first chunk, then write the partial
+            # answer periodically so a dropped connection doesn't lose it
+            if assistant_entry is None:
+                assistant_entry = new_history_entry('assistant', ''.join(chunks))
+                saved = update_chat_history([user_entry, assistant_entry], hold_last=True)
+                if message_writer is None:
+                    message = saved[-1] if saved else None
+                last_saved = time.monotonic()
+            elif time.monotonic() - last_saved >= STREAM_SAVE_INTERVAL:
+                if message is not None:
+                    save_streamed_message(message, ''.join(chunks))
+                elif message_writer is not None:
+                    # The queued answer is held back until the stream ends, so only update it in memory
+                    message_writer.update(get_or_create_conversation().id, assistant_entry, ''.join(chunks))
+                last_saved = time.monotonic()
+        completed = True
+        if cached_message is None:
+            stage_duration.observe(time.perf_counter() - llm_started, stage='llm_total', **metric_labels())
+            if own_call.is_set():
+                record_llm_tokens(complete_prompt, system_prompt, ''.join(chunks))
+    finally:
+        if assistant_entry is None:
+            # Nothing was generated, but keep the user's message
+            update_chat_history([user_entry])
+        else:
+            # Persist whatever was generated, even if the client disconnected mid-stream
+            assistant_message = ''.join(chunks)
+            assistant_entry['content'] = assistant_message
+            assistant_entry['html'] = g.response_html = render_markdown(assistant_message)
+            if message_writer is not None:
+                # Release the queued answer for the next flush
+                message_writer.finish(get_or_create_conversation().id, assistant_entry)
+            if message is not None and message.content != assistant_message:
+                save_streamed_message(message, assistant_message, assistant_entry['html'])
+            
+            # Only complete answers of the full model are cached
+            if completed and cache_key and cached_message is None and not isinstance(chunks[0], DegradedText):
+                response_cache.set(cache_key, assistant_message)
+
+def overloaded_response():
+    """Response returned when the LLM wait queue is full"""
+    response = jsonify({'error': 'The AI mentor is busy right now. Please try again in a few seconds.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(llm_limiter.retry_after)
+    return response
+
+def format_sse(payload):
+    """Format a payload as a server-sent event"""
+    return f"data: {json.dumps(payload)}\n\n"
 
 @app.route('/')
 def index():
@@ -367,22 +985,258 @@ def chat():
         if not user_message:
             return jsonify({'error': 'Message is required'}), 400
         
-        # Set persona if provided
-        if persona:
-            if not set_persona(persona):
-                return jsonify({'error': 'Invalid persona'}), 400
+        # Wait for a free LLM slot before doing any database work
+        if not llm_limiter.acquire():
+            return overloaded_response()
         
-        # Generate response using the conversation history
-        assistant_message = generate_response(user_message, action)
+        try:
+            # Set persona if provided
+            if persona:
+                if not set_persona(persona):
+                    return jsonify({'error': 'Invalid persona'}), 400
+            set_metric_labels(get_current_persona(), action)
+            
+            # Generate response using the conversation history
+            assistant_message = generate_response(user_message, action)
+        finally:
+            llm_limiter.release()
         
-        return jsonify({
+        response = jsonify({
             'response': assistant_message,
+            'html': stored_html(g.get('response_html')),
             'persona': get_current_persona()
         })
         
+        # Fold messages that fell out of the context window into the summary once the response is sent
+        if g.get('summary_due'):
+            response.call_on_close(partial(update_conversation_summary, g.conversation.id))
+        
+        return response
+        
     except Exception as e:
         logging.error(f"Error processing chat request: {str(e)}")
-        return jsonify({'error': f'Failed to get response: {str(e)}'}), 500
+        return jsonify({'error': LLM_ERROR_MESSAGE}), 500
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Stream a chat response from Google Gemini as server-sent events"""
+    try:
+        data = request.json
+        user_message = data.get('message', '')
+        persona = data.get('persona')
+        action = data.get('action')
+        
+        if not user_message:
+            return jsonify({'error': 'Message is required'}), 400
+        
+        # Wait for a free LLM slot before doing any database work
+        if not llm_limiter.acquire():
+            return overloaded_response()
+        
+        try:
+            # Set persona if provided
+            if persona:
+                if not set_persona(persona):
+                    llm_limiter.release()
+                    return jsonify({'error': 'Invalid persona'}), 400
+            
+            # Make sure the session cookie is set before the response headers are sent
+            conversation_id = get_or_create_conversation().id
+            set_metric_labels(get_current_persona(), action)
+        except Exception:
+            llm_limiter.release()
+            raise
+        
+        summary_due = []
+        
+        def event_stream():
+            try:
+                for text in generate_response_stream(user_message, action):
+                    yield format_sse({'type': 'chunk', 'text': text})
+                summary_due.append(g.get('summary_due', False))
+                yield format_sse({
+                    'type': 'done',
+                    'persona': get_current_persona(),
+                    'html': stored_html(g.get('response_html'))
+                })
+            except Exception as e:
+                logging.error(f"Error streaming response: {str(e)}")
+                yield format_sse({'type': 'error', 'error': LLM_ERROR_MESSAGE})
+        
+        response = Response(
+            stream_with_context(event_stream()),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'  # Disable proxy buffering so chunks arrive immediately
+            }
+        )
+        # The LLM slot is held until the stream finishes or the client disconnects
+        response.call_on_close(llm_limiter.release)
+        
+        # Fold messages that fell out of the context window into the summary once the stream ends
+        def summarize_if_due():
+            if any(summary_due):
+                update_conversation_summary(conversation_id)
+        
+        response.call_on_close(summarize_if_due)
+        return response
+        
+    except Exception as e:
+        logging.error(f"Error processing chat stream request: {str(e)}")
+        return jsonify({'error': LLM_ERROR_MESSAGE}), 500
+
+def run_batch_item(item, started, token_usage=None):
+    """Generate the response to one /api/chat/batch item in a worker thread
+
+    token_usage is the request's g.llm_token_usage; the item's app context has a g of
+    its own, so its LLM tokens are only charged to the rate limits through it.
+    """
+    started.append(time.monotonic())
+    with app.app_context():
+        set_metric_labels(item['persona'], item['action'])
+        if token_usage is not None:
+            g.llm_token_usage = token_usage
+        # Batch items count against the same per-worker LLM limit as chat requests
+        if not llm_limiter.acquire():
+            raise RuntimeError('The AI mentor is busy right now')
+        try:
+            return generate_standalone_response(item['message'], item['persona'], item['action'])
+        finally:
+            llm_limiter.release()
+
+def parse_batch_item(item):
+    """Validate a batch item, returning (item, error)"""
+    if not isinstance(item, dict):
+        return None, 'Item must be an object'
+    
+    message = item.get('message')
+    persona = item.get('persona') or 'general'
+    action = item.get('action') or None
+    
+    if not message or not isinstance(message, str):
+        return None, 'Message is required'
+    if persona not in PERSONA_PROMPTS:
+        return None, 'Invalid persona'
+    if action is not None and action not in ACTION_PROMPTS.get(persona, {}):
+        return None, 'Invalid action for this persona'
+    
+    return {'id': item.get('id'), 'persona': persona, 'action': action, 'message': message}, None
+
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_batch():
+    """Generate responses for standalone persona/action prompts, streamed as NDJSON lines as they finish"""
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items must be a non-empty list'}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'At most {BATCH_MAX_ITEMS} items are allowed per batch'}), 400
+    
+    def result_line(index, item, **fields):
+        return json.dumps(dict(
+            type='result',
+            index=index,
+            id=item.get('id') if isinstance(item, dict) else None,
+            **fields
+        )) + "\n"
+    
+    token_usage = g.get('llm_token_usage')
+    
+    def results():
+        batch_started = time.monotonic()
+        succeeded = failed = 0
+        pool = ThreadPoolExecutor(max_workers=min(BATCH_MAX_CONCURRENCY, len(items)), thread_name_prefix='batch')
+        pending = {}  # future -> (index, item, [start time once it runs])
+        
+        try:
+            for index, raw_item in enumerate(items):
+                item, error = parse_batch_item(raw_item)
+                if error:
+                    failed += 1
+                    yield result_line(index, raw_item, status='error', error=error)
+                    continue
+                started = []
+                pending[pool.submit(run_batch_item, item, started, token_usage)] = (index, item, started)
+            
+            while pending:
+                # Wake up for the next completion or the next item to run out of time
+                now = time.monotonic()
+                deadlines = [started[0] + BATCH_ITEM_TIMEOUT for _, _, started in pending.values() if started]
+                timeout = max(min(deadlines) - now, 0) if deadlines else BATCH_ITEM_TIMEOUT
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                
+                for future in done:
+                    index, item, started = pending.pop(future)
+                    elapsed_ms = round((time.monotonic() - started[0]) * 1000) if started else 0
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        logging.error(f"Error generating batch item {index}: {str(e)}")
+                        failed += 1
+                        yield result_line(index, item, status='error', error=LLM_ERROR_MESSAGE, elapsed_ms=elapsed_ms)
+                    else:
+                        succeeded += 1
+                        yield result_line(index, item, status='ok', persona=item['persona'], action=item['action'], response=response, elapsed_ms=elapsed_ms)
+                
+                # The thread of a timed-out item finishes in the background; its result is dropped
+                now = time.monotonic()
+                for future, (index, item, started) in list(pending.items()):
+                    if started and now - started[0] >= BATCH_ITEM_TIMEOUT:
+                        del pending[future]
+                        failed += 1
+                        yield result_line(index, item, status='error', error=f'Timed out after {BATCH_ITEM_TIMEOUT:g} seconds', elapsed_ms=round((now - started[0]) * 1000))
+            
+            yield json.dumps({
+                'type': 'done',
+                'succeeded': succeeded,
+                'failed': failed,
+                'elapsed_ms': round((time.monotonic() - batch_started) * 1000)
+            }) + "\n"
+        finally:
+            # Also runs when the client disconnects: don't start items nobody will read
+            pool.shutdown(wait=False, cancel_futures=True)
+    
+    return Response(
+        stream_with_context(results()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/export', methods=['GET'])
+def export_conversation():
+    """Download the session's conversation as NDJSON (see transfer.export_lines)
+
+    Pass `gzip=true` for a gzipped file. The rows are streamed from the database as
+    the response is sent, however long the conversation is. An answer that is still
+    being streamed (and the messages queued after it) isn't included.
+    """
+    session_id = session.get('session_id')
+    compress = request.args.get('gzip', 'false').lower() == 'true'
+    
+    # Messages still queued by the write-behind writer belong in the export
+    if message_writer is not None and session_id:
+        conversation_id = db.session.execute(
+            select(Conversation.id).where(Conversation.session_id == session_id)
+        ).scalar()
+        if conversation_id is not None:
+            message_writer.flush(conversation_id=conversation_id)
+    
+    def lines():
+        with db.engine.connect() as connection:
+            yield from export_lines(connection, Conversation.session_id == (session_id or ''))
+    
+    filename = f"edubuddy-conversation.ndjson{'.gz' if compress else ''}"
+    return Response(
+        stream_with_context(gzip_chunks(lines()) if compress else lines()),
+        mimetype='application/gzip' if compress else 'application/x-ndjson',
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no'
+        }
+    )
 
 @app.route('/api/reset', methods=['POST'])
 def reset_conversation():
@@ -391,19 +1245,26 @@ def reset_conversation():
         # Get the session ID
         session_id = get_or_create_session_id()
         
-        # Find the conversation in the database
-        conversation = Conversation.query.filter_by(session_id=session_id).first()
+        # Reset the persona and summary without loading the conversation; bumping
+        # updated_at invalidates cached copies of the history
+        conversation_id = db.session.execute(
+            update(Conversation)
+            .where(Conversation.session_id == session_id)
+            .values(persona=None, summary=None, summary_until=None, updated_at=datetime.utcnow())
+            .returning(Conversation.id)
+        ).scalar()
         
-        if conversation:
-            # Delete all messages associated with this conversation
-            Message.query.filter_by(conversation_id=conversation.id).delete()
-            
-            # Reset the persona
-            conversation.persona = None
-            
-            # Commit changes
-            db.session.commit()
-            logging.info(f"Cleared database messages for conversation ID: {conversation.id}")
+        if conversation_id is not None:
+            # Drop messages still queued for the database, then delete the stored ones in bulk
+            if message_writer is not None:
+                message_writer.discard(conversation_id)
+            db.session.execute(
+                delete(Message).where(Message.conversation_id == conversation_id),
+                execution_options={'synchronize_session': False}
+            )
+            logging.info(f"Cleared database messages for conversation ID: {conversation_id}")
+        
+        db.session.commit()
         
         # Also clear session data as a fallback
         if 'chat_history' in session:
@@ -445,24 +1306,250 @@ def set_chat_persona():
 
 @app.route('/api/history', methods=['GET'])
 def get_conversation_history():
-    """Get the conversation history"""
+    """Get one page of the conversation history, newest page first
+
+    Pass `before` (the `next_cursor` of the previous page) to fetch older messages.
+    Responses carry an ETag and Last-Modified derived from the conversation's
+    updated_at, so unchanged histories are answered with 304 Not Modified.
+    """
     try:
-        # Get the conversation history
-        history = get_chat_history()
+        limit = request.args.get('limit', HISTORY_PAGE_SIZE, type=int)
+        if limit < 1:
+            return jsonify({'error': 'limit must be a positive integer'}), 400
+        limit = min(limit, HISTORY_MAX_PAGE_SIZE)
         
-        # Get current persona
-        persona = get_current_persona()
+        cursor = request.args.get('before')
+        try:
+            before = decode_history_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # The history only changes when the conversation's updated_at (or its queued messages) do
+        conversation = get_or_create_conversation()
+        last_modified = conversation.updated_at
+        fingerprint = f"{conversation.id}:{conversation.updated_at.isoformat()}:{limit}:{cursor or ''}"
+        if message_writer is not None:
+            pending = message_writer.pending(conversation.id)
+            if pending:
+                last_modified = max(last_modified, pending[-1]['timestamp'])
+            fingerprint += f":{message_writer.version(conversation.id)}"
+        etag = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+        
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = Response(status=304)
+        else:
+            # Get the page of conversation history and the current persona
+            history, next_cursor = get_chat_history_page(limit, before)
+            persona = get_current_persona()
+            
+            response = jsonify({
+                'success': True,
+                'history': history,
+                'persona': persona,
+                'has_more': next_cursor is not None,
+                'next_cursor': next_cursor
+            })
+        
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # Browsers may keep the history but must revalidate it on every load
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    except Exception as e:
+        logging.error(f"Error getting conversation history: {str(e)}")
+        # Rollback the session in case of error
+        db.session.rollback()
+        return jsonify({'error': f'Failed to get conversation history: {str(e)}'}), 500
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+def client_ip():
+    """The client's address, taken from X-Forwarded-For when behind RATE_LIMIT_PROXY_HOPS proxies"""
+    if RATE_LIMIT_PROXY_HOPS:
+        forwarded = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',') if ip.strip()]
+        if len(forwarded) >= RATE_LIMIT_PROXY_HOPS:
+            return forwarded[-RATE_LIMIT_PROXY_HOPS]
+    return request.remote_addr or 'unknown'
+
+def estimate_request_tokens():
+    """Estimated LLM tokens of a chat or batch request, from its messages alone"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return 0
+    if request.endpoint == 'chat_batch':
+        items = data.get('items') if isinstance(data.get('items'), list) else []
+        messages = [item.get('message') for item in items[:BATCH_MAX_ITEMS] if isinstance(item, dict)]
+    else:
+        messages = [data.get('message')]
+    return sum(estimate_tokens(message) + RATE_LIMIT_RESPONSE_TOKENS for message in messages if isinstance(message, str) and message)
+
+@app.before_request
+def enforce_rate_limits():
+    """Reject LLM requests over a rate limit before any database or LLM work is done"""
+    if rate_limiter is None or request.endpoint not in RATE_LIMITED_ENDPOINTS:
+        return None
+    
+    # Only an existing session has a bucket; a new one would get a full bucket on every request
+    session_id = session.get('session_id')
+    ip = client_ip()
+    tokens = estimate_request_tokens()
+    charges = [('ip_requests', ip, 1), ('ip_tokens', ip, tokens)]
+    if session_id:
+        charges = [('session_requests', session_id, 1), ('session_tokens', session_id, tokens)] + charges
+    
+    g.rate_limit = rate_limiter.check(charges)
+    if g.rate_limit is not None and not g.rate_limit.allowed:
+        return jsonify({'error': 'You are sending messages too quickly. Please wait a moment and try again.'}), 429
+    
+    g.llm_token_usage = {'tokens': 0, 'estimate': tokens, 'keys': [('session_tokens', session_id), ('ip_tokens', ip)]}
+
+@app.after_request
+def add_rate_limit_headers(response):
+    """Add the RateLimit headers, and settle the token estimate once the response has been sent"""
+    if g.get('rate_limit') is not None:
+        response.headers.update(g.rate_limit.headers())
+    
+    usage = g.get('llm_token_usage')
+    if usage is not None:
+        def settle():
+            # Runs after the app context is gone; the database bucket store needs one
+            with app.app_context():
+                # Answers from the cache or another request's identical call cost nothing and are refunded
+                difference = usage['tokens'] - usage['estimate']
+                if difference:
+                    for name, key in usage['keys']:
+                        if key:
+                            rate_limiter.charge(name, key, difference)
+        
+        response.call_on_close(settle)
+    return response
+
+@app.after_request
+def record_request_duration(response):
+    """Observe the request duration once the response, including any stream, has been sent"""
+    if 'request_started' not in g or request.endpoint in ('static', 'prometheus_metrics'):
+        return response
+    
+    started = g.request_started
+    labels = dict(
+        endpoint=request.endpoint or 'unknown',
+        method=request.method,
+        status=response.status_code,
+        **metric_labels()
+    )
+    
+    def observe():
+        request_duration.observe(time.perf_counter() - started, **labels)
+        metrics.maybe_flush()
+    
+    response.call_on_close(observe)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Request, stage and token metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# Whether the database has a full-text index (see search.py); checked on the first search
+search_indexed = None
+
+@app.route('/api/search', methods=['GET'])
+def search_conversation_history():
+    """Full-text search of the conversation history, best matches first
+
+    Takes the search text in `q`, plus `limit` and `offset` for paging. Each result
+    has the message's id, role and timestamp, a relevance score and an HTML snippet
+    with the matched words in <mark> tags. Messages still queued by the write-behind
+    writer become searchable once they are flushed.
+    """
+    global search_indexed
+    
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'error': 'q is required'}), 400
+        
+        limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+        offset = request.args.get('offset', 0, type=int)
+        if limit < 1 or offset < 0:
+            return jsonify({'error': 'limit must be positive and offset non-negative'}), 400
+        limit = min(limit, SEARCH_MAX_PAGE_SIZE)
+        
+        conversation = get_or_create_conversation()
+        connection = db.session.connection()
+        if search_indexed is None:
+            search_indexed = has_search_index(connection)
+        
+        # Fetch one extra result to find out whether there is another page
+        with stage_duration.time(stage='db_search', **metric_labels()):
+            results = search_messages(connection, conversation.id, query, limit + 1, offset, indexed=search_indexed)
+        has_more = len(results) > limit
         
         return jsonify({
             'success': True,
-            'history': history,
-            'persona': persona
+            'query': query,
+            'results': results[:limit],
+            'has_more': has_more,
+            'next_offset': offset + limit if has_more else None
         })
     except Exception as e:
-        logging.error(f"Error getting conversation history: {str(e)}")
+        logging.error(f"Error searching conversation history: {str(e)}")
         # Rollback the session in case of error
         db.session.rollback()
-        return jsonify({'error': f'Failed to get conversation history: {str(e)}'}), 500
+        return jsonify({'error': f'Failed to search conversation history: {str(e)}'}), 500
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness probe: the worker is up and serving requests"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness probe: the database schema is reachable and the LLM backend is initialized
+
+    The first call also initializes the LLM backend, so it doubles as a worker warm-up.
+    """
+    checks = {}
+    
+    try:
+        db.session.execute(select(Conversation.id).limit(1))
+        checks['database'] = 'ok'
+    except Exception as e:
+        db.session.rollback()
+        checks['database'] = f'error: {str(e)}'
+    
+    try:
+        checks['llm'] = llm.get().name
+    except Exception as e:
+        checks['llm'] = f'error: {str(e)}'
+    
+    ready = checks['database'] == 'ok' and not checks['llm'].startswith('error')
+    timings = dict(startup_timings)
+    if llm.init_seconds is not None:
+        timings['llm_init_ms'] = llm.init_seconds * 1000
+    
+    return jsonify({
+        'status': 'ready' if ready else 'unavailable',
+        'checks': checks,
+        'startup_timings': {name: round(ms, 1) for name, ms in timings.items()}
+    }), 200 if ready else 503
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """Cache and concurrency statistics for this worker"""
+    return jsonify({
+        'llm_backend': llm.name,
+        'prefix_cache': llm.prefix_cache_stats.snapshot(),
+        'response_cache': response_cache.stats(),
+        'llm_limiter': llm_limiter.stats(),
+        'write_behind': message_writer.stats() if message_writer is not None else None,
+        'single_flight': llm_flights.stats() if llm_flights is not None else None,
+        'rate_limit': rate_limiter.stats() if rate_limiter is not None else None,
+        'llm_resilience': llm.stats() if llm.initialized else None
+    })
 
 # Error handlers
 @app.errorhandler(404)
@@ -472,3 +1559,138 @@ def page_not_found(e):
 @app.errorhandler(500)
 def server_error(e):
     return jsonify({'error': 'Internal server error'}), 500
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the database tables and bring existing ones up to date"""
+    upgrade_schema()
+    click.echo('Database schema is up to date.')
+
+@app.cli.command('archive-conversations')
+@click.option('--idle-days', type=int, default=RETENTION_IDLE_DAYS, show_default=True,
+              help='Archive conversations not updated for this many days.')
+@click.option('--short-idle-days', type=int, default=RETENTION_SHORT_IDLE_DAYS, show_default=True,
+              help='Archive abandoned conversations (see --short-max-messages) sooner; -1 disables this.')
+@click.option('--short-max-messages', type=int, default=RETENTION_SHORT_MAX_MESSAGES, show_default=True,
+              help='Conversations with at most this many messages count as abandoned.')
+@click.option('--archive-dir', default=RETENTION_ARCHIVE_DIR, show_default=True,
+              help='Directory for the gzipped NDJSON archive files and the journal.')
+@click.option('--batch-size', type=int, default=RETENTION_BATCH_SIZE, show_default=True,
+              help='Conversations per archive file and delete.')
+@click.option('--max-batches', type=int, default=None, help='Stop after this many batches.')
+@click.option('--dry-run', is_flag=True, help='Only report what would be archived.')
+@click.option('--compact', is_flag=True, help='Purge expired cache rows and VACUUM afterwards.')
+def archive_conversations_command(idle_days, short_idle_days, short_max_messages, archive_dir,
+                                  batch_size, max_batches, dry_run, compact):
+    """Move idle conversations to archive files and delete them from the database
+
+    Meant to run as a scheduled job; an interrupted run is completed by the next one.
+    """
+    policy = RetentionPolicy(
+        idle_days=idle_days,
+        short_idle_days=short_idle_days if short_idle_days >= 0 else None,
+        short_max_messages=short_max_messages
+    )
+    archiver = ConversationArchiver(policy, archive_dir, batch_size=batch_size)
+    
+    if dry_run:
+        report = archiver.report()
+        click.echo(f"Policy: {report['policy']}")
+        click.echo(f"Would archive {report['conversations']} of {report['total_conversations']} conversations "
+                   f"({report['messages']} messages, {report['content_bytes']} bytes of text)")
+        if report['oldest_updated_at']:
+            click.echo(f"Oldest conversation last updated {report['oldest_updated_at']}")
+        if report['unfinished_batches']:
+            click.echo(f"{report['unfinished_batches']} interrupted batches would be deleted first")
+        return
+    
+    totals = archiver.run(max_batches=max_batches)
+    click.echo(f"Archived and deleted {totals['conversations']} conversations ({totals['messages']} messages) "
+               f"in {len(totals['files'])} files under {archive_dir}")
+    if totals['resumed']:
+        click.echo(f"Completed {totals['resumed']} interrupted batches")
+    
+    if compact:
+        purged = purge_expired_rows()
+        compact_database()
+        click.echo(f"Purged {purged['cached_responses']} cached responses and "
+                   f"{purged['inflight_calls']} in-flight calls; database compacted")
+
+@app.cli.command('export-conversations')
+@click.argument('output', type=click.Path(dir_okay=False, allow_dash=True), default='-')
+@click.option('--session-id', 'session_ids', multiple=True, help='Only export these sessions (repeatable).')
+@click.option('--updated-since', type=click.DateTime(), help='Only export conversations updated since then (UTC).')
+@click.option('--gzip', 'compress', is_flag=True, help='Gzip the output; implied by a .gz file name.')
+@click.option('--chunk-size', type=int, default=1000, show_default=True, help='Rows fetched per round trip.')
+def export_conversations_command(output, session_ids, updated_since, compress, chunk_size):
+    """Stream conversations and their messages as NDJSON to OUTPUT (default: stdout)"""
+    conditions = []
+    if session_ids:
+        conditions.append(Conversation.session_id.in_(session_ids))
+    if updated_since:
+        conditions.append(Conversation.updated_at >= updated_since)
+    compress = compress or output.endswith('.gz')
+    
+    counts = {}
+    with db.engine.connect() as connection:
+        lines = export_lines(connection, and_(*conditions) if conditions else None, chunk_size, counts)
+        chunks = gzip_chunks(lines) if compress else (line.encode('utf-8') for line in lines)
+        with click.open_file(output, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+    click.echo(f"Exported {counts['conversations']} conversations and {counts['messages']} messages", err=True)
+
+@app.cli.command('import-conversations')
+@click.argument('source', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--batch-size', type=int, default=1000, show_default=True, help='Rows per INSERT.')
+@click.option('--preserve-ids', is_flag=True, help='Keep the exported ids instead of assigning new ones.')
+@click.option('--dry-run', is_flag=True, help='Validate and import, then roll everything back.')
+def import_conversations_command(source, batch_size, preserve_ids, dry_run):
+    """Import an NDJSON export (gzipped or not) from SOURCE in a single transaction
+
+    Conversations whose session already exists are skipped. An invalid or truncated
+    file is rejected as a whole.
+    """
+    raw = sys.stdin.buffer if source == '-' else open(source, 'rb')
+    try:
+        # Gzipped files are recognized by their magic number
+        if raw.peek(2)[:2] == b'\x1f\x8b':
+            raw = gzip.GzipFile(fileobj=raw)
+        lines = io.TextIOWrapper(raw, encoding='utf-8')
+        
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        try:
+            counts = ConversationImporter(connection, batch_size, preserve_ids).import_lines(lines)
+            if dry_run:
+                transaction.rollback()
+            else:
+                transaction.commit()
+        except ImportValidationError as e:
+            transaction.rollback()
+            raise click.ClickException(f"Nothing imported: {str(e)}")
+        finally:
+            connection.close()
+    finally:
+        raw.close()
+    
+    click.echo(f"{'Would import' if dry_run else 'Imported'} {counts['conversations']} conversations and "
+               f"{counts['messages']} messages; skipped {counts['skipped_conversations']} existing conversations "
+               f"({counts['skipped_messages']} messages)")
+    if counts['summaries_dropped']:
+        click.echo(f"Dropped {counts['summaries_dropped']} summaries that referred to messages missing from the file")
+
+@app.cli.command('list-models')
+def list_models_command():
+    """Log the Gemini models available to the configured API key"""
+    backend = llm.get().primary
+    if not isinstance(backend, GeminiBackend):
+        click.echo(f'The {backend.name} backend has no model list.')
+        return
+    backend.log_available_models()
+
+startup_timings['total_ms'] = (time.perf_counter() - _boot_started) * 1000
+logging.info(
+    "Startup: imports %.1f ms, database %.1f ms, total %.1f ms (LLM backend initialized on first use)",
+    startup_timings['imports_ms'], startup_timings['database_ms'], startup_timings['total_ms']
+)
@@ -0,0 +1,162 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from models import db, CachedResponse
+
+
+def normalize_text(text):
+    """Collapse whitespace and case so trivially different prompts share a cache entry"""
+    return " ".join(text.split()).casefold()
+
+
+def make_cache_key(persona, action, user_message, context):
+    """Fingerprint of everything that determines the model's answer"""
+    fingerprint = json.dumps([
+        persona or "",
+        action or "",
+        normalize_text(user_message),
+        [(msg['role'], normalize_text(msg['content'])) for msg in context]
+    ])
+    return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe in-process cache with size-based LRU and TTL eviction"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResponseCache:
+    """Cache of model responses for standalone persona/action prompts
+
+    Lookups go to the in-process LRU first and then, if enabled, to a shared table
+    that every gunicorn worker can see. Errors in the shared tier are logged and
+    treated as misses so the cache can never break a chat request.
+    """
+
+    # Delete expired rows from the shared table once every this many writes
+    SWEEP_EVERY = 100
+
+    def __init__(self, enabled=True, max_entries=512, ttl=3600, shared=False):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.shared = shared
+        self.local = LRUCache(max_entries, ttl)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.counters = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'bypassed': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def key_for(self, persona, action, user_message, context):
+        """Return the cache key for a request, or None when the cache must be bypassed
+
+        A follow-up question depends on the whole conversation, so only the first message
+        of a conversation and quick actions are cached. Quick actions include their
+        recent context in the key.
+        """
+        if not self.enabled:
+            return None
+
+        if context and not action:
+            self._count('bypassed')
+            return None
+
+        return make_cache_key(persona, action, user_message, context)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self._count('local_hits')
+            return value
+
+        if self.shared:
+            try:
+                entry = db.session.get(CachedResponse, key)
+                if entry is not None and entry.expires_at > datetime.utcnow():
+                    remaining = (entry.expires_at - datetime.utcnow()).total_seconds()
+                    self.local.set(key, entry.response, ttl=remaining)
+                    self._count('shared_hits')
+                    return entry.response
+            except Exception as e:
+                logging.error(f"Error reading shared response cache: {str(e)}")
+                db.session.rollback()
+
+        self._count('misses')
+        return None
+
+    def set(self, key, response):
+        self.local.set(key, response)
+
+        if not self.shared:
+            return
+
+        try:
+            now = datetime.utcnow()
+            db.session.merge(CachedResponse(
+                key=key,
+                response=response,
+                created_at=now,
+                expires_at=now + timedelta(seconds=self.ttl)
+            ))
+
+            with self._lock:
+                self._writes += 1
+                sweep = self._writes % self.SWEEP_EVERY == 0
+            if sweep:
+                CachedResponse.query.filter(CachedResponse.expires_at <= now).delete()
+
+            db.session.commit()
+        except Exception as e:
+            logging.error(f"Error writing shared response cache: {str(e)}")
+            db.session.rollback()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['entries'] = len(self.local)
+        stats['evictions'] = self.local.evictions
+        return stats
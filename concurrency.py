@@ -0,0 +1,57 @@
+import time
+import threading
+
+
+class LLMConcurrencyLimiter:
+    """Caps the number of in-flight LLM calls in this worker, with a bounded wait queue
+
+    Requests beyond max_in_flight wait for a free slot. Once max_queue requests are
+    already waiting (or a waiter times out), acquire() returns False and the caller
+    should reject the request with 503 and a Retry-After header.
+    """
+
+    def __init__(self, max_in_flight, max_queue, queue_timeout, retry_after):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._in_flight = 0
+        self._waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Take an LLM slot, waiting in the queue if needed. Returns False when overloaded"""
+        deadline = time.monotonic() + self.queue_timeout
+
+        with self._condition:
+            if self._in_flight < self.max_in_flight:
+                self._in_flight += 1
+                return True
+
+            # Reject immediately if the wait queue is already full
+            if self._waiting >= self.max_queue:
+                return False
+
+            self._waiting += 1
+            try:
+                while self._in_flight >= self.max_in_flight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+
+                self._in_flight += 1
+                return True
+            finally:
+                self._waiting -= 1
+
+    def release(self):
+        """Give back an LLM slot and wake up the next waiting request"""
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def stats(self):
+        """Current number of in-flight and waiting LLM requests"""
+        with self._condition:
+            return {'in_flight': self._in_flight, 'waiting': self._waiting}
@@ -0,0 +1,77 @@
+# Marker inserted where the middle of an oversized message was cut out
+TRUNCATION_MARKER = "\n\n[... truncated ...]\n\n"
+
+SUMMARY_PROMPT = """Update the running summary of a tutoring conversation between a student and an AI mentor.
+Keep the topics covered, key explanations and conclusions, the student's goals and level, and any open questions.
+Write plain prose of at most {max_words} words.
+
+Current summary:
+{summary}
+
+New messages to fold into the summary:
+{messages}
+
+Updated summary:"""
+
+
+def estimate_tokens(text):
+    """Cheap token estimate: roughly four characters per token for English text and code"""
+    return len(text) // 4 + 1
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Shorten text to about max_tokens, keeping its beginning and end"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    max_chars = max(max_tokens * 4 - len(TRUNCATION_MARKER), 0)
+    head = max_chars * 2 // 3
+    tail = max_chars - head
+    return text[:head] + TRUNCATION_MARKER + (text[-tail:] if tail else "")
+
+
+def select_context(history, budget, max_message_tokens):
+    """Fill a token budget with the newest messages of a conversation
+
+    Messages longer than max_message_tokens are truncated first, so one huge paste
+    can't crowd out the rest of the conversation. Returns (context, older): the
+    messages that fit, oldest first, and the older messages that didn't.
+    """
+    context = []
+    used = 0
+
+    for index in range(len(history) - 1, -1, -1):
+        message = history[index]
+        content = truncate_to_tokens(message['content'], max_message_tokens)
+        tokens = estimate_tokens(content)
+        if used + tokens > budget:
+            return context[::-1], history[:index + 1]
+
+        context.append(dict(message, content=content))
+        used += tokens
+
+    return context[::-1], []
+
+
+def format_transcript(messages):
+    """Format messages as a User / AI Mentor transcript for a prompt"""
+    transcript = ""
+    for msg in messages:
+        if msg['role'] == 'user':
+            transcript += f"User: {msg['content']}\n\n"
+        else:  # assistant
+            transcript += f"AI Mentor: {msg['content']}\n\n"
+    return transcript
+
+
+def build_summary_prompt(summary, messages, max_words, max_message_tokens):
+    """Prompt asking the model to fold messages into the running summary"""
+    messages = [
+        dict(message, content=truncate_to_tokens(message['content'], max_message_tokens))
+        for message in messages
+    ]
+    return SUMMARY_PROMPT.format(
+        max_words=max_words,
+        summary=summary or "(none yet)",
+        messages=format_transcript(messages)
+    )
@@ -0,0 +1,58 @@
+import os
+import multiprocessing
+
+# Gunicorn settings, configurable through environment variables.
+#
+# The default "gthread" worker serves each request on its own thread, so a worker
+# waiting on a Gemini round-trip keeps serving other chats. For very high concurrency
+# use GUNICORN_WORKER_CLASS=gevent (requires `pip install gevent`); the Gemini client
+# is switched to the REST transport in that mode because gRPC isn't green-thread safe.
+# The number of concurrent LLM calls per worker is capped separately by LLM_MAX_IN_FLIGHT,
+# with up to LLM_MAX_QUEUE more requests waiting for a slot. Both default to a share of
+# GUNICORN_THREADS (a half and a quarter); when setting them by hand keep their sum below
+# the thread count, or requests pile up in the connection backlog instead of getting a 503.
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", min(multiprocessing.cpu_count() * 2 + 1, 4)))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+# Streaming responses and slow LLM calls can legitimately take a while
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+
+# Import the app once in the master so workers fork with it already loaded. The app
+# creates no network clients on import (the LLM backend is initialized lazily), and
+# each worker drops the database connections inherited from the master in post_fork.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() == "true"
+
+if worker_class == "gevent":
+    os.environ.setdefault("GEMINI_TRANSPORT", "rest")
+
+
+def on_starting(server):
+    # Metric snapshots left by the workers of a previous run would be added to the new totals
+    metrics_dir = os.environ.get("METRICS_DIR")
+    if metrics_dir and os.path.isdir(metrics_dir):
+        for name in os.listdir(metrics_dir):
+            if name.startswith("metrics-"):
+                os.remove(os.path.join(metrics_dir, name))
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    from app import app
+    from models import db
+    with app.app_context():
+        # close=False leaves the parent's connections alone instead of closing them from the child
+        db.engine.dispose(close=False)
+
+
+def worker_exit(server, worker):
+    # Write messages still queued by the write-behind writer before the worker goes away
+    from app import message_writer
+    if message_writer is not None:
+        message_writer.close()
@@ -0,0 +1,342 @@
+import os
+import time
+import random
+import logging
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
+
+
+class PrefixCacheStats:
+    """Counts how often the static prompt prefix (system instruction) is served from a cache
+
+    Tracked per system prompt name: requests, prompt tokens sent and prompt tokens the
+    provider reported as read from its cache instead of being processed again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, name, prompt_tokens, cached_tokens):
+        with self._lock:
+            stats = self._stats.setdefault(name, {'requests': 0, 'cache_hits': 0, 'prompt_tokens': 0, 'cached_tokens': 0})
+            stats['requests'] += 1
+            stats['prompt_tokens'] += prompt_tokens
+            stats['cached_tokens'] += cached_tokens
+            if cached_tokens:
+                stats['cache_hits'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+class LLMBackend:
+    """Interface for the text generation backends used by the chat endpoints
+
+    System prompts are registered once at startup with register_system_prompts and
+    then referred to by name, so backends can build a model handle per prompt and
+    reuse the provider's prefix caching for it.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.system_prompts = {}
+        self.prefix_cache_stats = PrefixCacheStats()
+
+    def register_system_prompts(self, system_prompts):
+        """Register named system instructions, e.g. one per persona and action"""
+        self.system_prompts.update(system_prompts)
+
+    def generate(self, prompt, system=None):
+        """Generate the complete response text for a prompt, with an optional named system prompt"""
+        raise NotImplementedError
+
+    def stream(self, prompt, system=None):
+        """Yield the response text for a prompt chunk by chunk"""
+        raise NotImplementedError
+
+    def count_tokens(self, prompt):
+        """Count the tokens a prompt uses with this backend"""
+        raise NotImplementedError
+
+
+class GeminiBackend(LLMBackend):
+    """Google Gemini backend
+
+    Each registered system prompt gets its own GenerativeModel with the prompt as its
+    system instruction. With context_cache enabled, prompts long enough for Gemini's
+    context caching are uploaded once as cached content and the model handle reads
+    them from the cache; the cache is recreated shortly before its TTL runs out.
+    request_timeout caps how long a single request (or a whole stream) may take.
+    """
+
+    name = "gemini"
+
+    # Recreate cached content this long before it expires
+    CACHE_REFRESH_MARGIN = timedelta(minutes=5)
+
+    def __init__(self, model_name, generation_config, api_key=None, transport=None,
+                 context_cache=False, context_cache_ttl=3600, context_cache_min_tokens=32768,
+                 request_timeout=None):
+        super().__init__()
+        import google.generativeai as genai
+
+        genai.configure(api_key=api_key, transport=transport)
+        self.genai = genai
+        self.model_name = model_name
+        self.generation_config = generation_config
+        self.context_cache = context_cache
+        self.context_cache_ttl = context_cache_ttl
+        self.context_cache_min_tokens = context_cache_min_tokens
+        self.request_options = {'timeout': request_timeout} if request_timeout else None
+        self.model = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config
+        )
+        self._models = {}  # system prompt name -> (model handle, cache expiry or None)
+        self._lock = threading.Lock()
+
+    def register_system_prompts(self, system_prompts):
+        super().register_system_prompts(system_prompts)
+        for name in system_prompts:
+            self._models[name] = self._build_model(name)
+
+    def _build_model(self, name):
+        instruction = self.system_prompts[name]
+
+        if self.context_cache:
+            try:
+                tokens = self.model.count_tokens(instruction).total_tokens
+                if tokens >= self.context_cache_min_tokens:
+                    cached_content = self.genai.caching.CachedContent.create(
+                        model=self.model_name,
+                        display_name=f"edubuddy-{name}",
+                        system_instruction=instruction,
+                        ttl=timedelta(seconds=self.context_cache_ttl)
+                    )
+                    model = self.genai.GenerativeModel.from_cached_content(
+                        cached_content,
+                        generation_config=self.generation_config
+                    )
+                    logging.info(f"Created context cache for system prompt '{name}' ({tokens} tokens)")
+                    return model, cached_content.expire_time
+                logging.debug(f"System prompt '{name}' has {tokens} tokens, too few for context caching")
+            except Exception as e:
+                logging.warning(f"Error creating context cache for system prompt '{name}': {str(e)}")
+
+        model = self.genai.GenerativeModel(
+            model_name=self.model_name,
+            generation_config=self.generation_config,
+            system_instruction=instruction
+        )
+        return model, None
+
+    def _model_for(self, system):
+        if system is None:
+            return self.model
+
+        model, expires_at = self._models[system]
+        if expires_at and datetime.now(timezone.utc) >= expires_at - self.CACHE_REFRESH_MARGIN:
+            with self._lock:
+                model, expires_at = self._models[system]
+                if datetime.now(timezone.utc) >= expires_at - self.CACHE_REFRESH_MARGIN:
+                    model, expires_at = self._models[system] = self._build_model(system)
+        return model
+
+    def _record_usage(self, system, response):
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is None:
+            return
+        self.prefix_cache_stats.record(
+            system or 'default',
+            usage.prompt_token_count,
+            getattr(usage, 'cached_content_token_count', 0) or 0
+        )
+
+    def generate(self, prompt, system=None):
+        response = self._model_for(system).generate_content(prompt, request_options=self.request_options)
+        self._record_usage(system, response)
+        return response.text
+
+    def stream(self, prompt, system=None):
+        response = self._model_for(system).generate_content(prompt, stream=True, request_options=self.request_options)
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+        # Usage metadata is complete once the stream has been consumed
+        self._record_usage(system, response)
+
+    def count_tokens(self, prompt):
+        return self.model.count_tokens(prompt).total_tokens
+
+    def log_available_models(self):
+        """Log the models available to the configured API key, for debugging"""
+        try:
+            available_models = self.genai.list_models()
+            logging.info("Available models:")
+            for model_info in available_models:
+                logging.info(f"- {model_info.name}")
+        except Exception as e:
+            logging.error(f"Error listing models: {str(e)}")
+
+
+class StubBackend(LLMBackend):
+    """Deterministic offline backend for development, load tests and benchmarks
+
+    The response is derived from a hash of the prompt, so the same prompt always gets
+    the same answer. latency is the time to the first chunk, output_words the response
+    length and chunk_delay the pause between streamed chunks. Prefix caching is
+    simulated: a system prompt counts as cached from its second use on.
+
+    To exercise the resilience layer, a failure_rate share of calls raise a
+    ConnectionError and a slow_rate share take slow_latency seconds instead.
+    """
+
+    name = "stub"
+
+    WORDS = (
+        "learning", "concept", "example", "step", "explain", "practice", "because",
+        "therefore", "model", "problem", "solution", "idea", "first", "next", "finally",
+        "simple", "important", "remember", "notice", "result"
+    )
+
+    def __init__(self, latency=0.5, output_words=200, chunk_words=8, chunk_delay=0.0,
+                 failure_rate=0.0, slow_rate=0.0, slow_latency=30.0):
+        super().__init__()
+        self.latency = latency
+        self.output_words = output_words
+        self.chunk_words = chunk_words
+        self.chunk_delay = chunk_delay
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self._used_systems = set()
+
+    def _wait_for_first_chunk(self):
+        if random.random() < self.failure_rate:
+            raise ConnectionError("Simulated LLM failure")
+        time.sleep(self.slow_latency if random.random() < self.slow_rate else self.latency)
+
+    def _words(self, prompt, system):
+        instruction = self.system_prompts[system] if system else ""
+        digest = hashlib.sha256((instruction + prompt).encode("utf-8")).digest()
+        return [
+            self.WORDS[digest[i % len(digest)] % len(self.WORDS)]
+            for i in range(self.output_words)
+        ]
+
+    def _record_usage(self, prompt, system):
+        instruction = self.system_prompts[system] if system else ""
+        cached = system in self._used_systems
+        self._used_systems.add(system)
+        self.prefix_cache_stats.record(
+            system or 'default',
+            self.count_tokens(instruction + prompt),
+            self.count_tokens(instruction) if cached and instruction else 0
+        )
+
+    def generate(self, prompt, system=None):
+        self._wait_for_first_chunk()
+        time.sleep(self.chunk_delay * (self.output_words // self.chunk_words))
+        self._record_usage(prompt, system)
+        return " ".join(self._words(prompt, system))
+
+    def stream(self, prompt, system=None):
+        self._wait_for_first_chunk()
+        self._record_usage(prompt, system)
+        words = self._words(prompt, system)
+        for i in range(0, len(words), self.chunk_words):
+            if i and self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            yield " ".join(words[i:i + self.chunk_words]) + " "
+
+    def count_tokens(self, prompt):
+        # Roughly four characters per token, like most subword tokenizers on English text
+        return max(1, len(prompt) // 4)
+
+
+class LazyBackend:
+    """Creates the real backend on first use
+
+    Keeps importing the app fast and fork-safe: with gunicorn --preload the app is
+    imported in the master process, and the Gemini gRPC client must only be created
+    in the workers. Attribute access is forwarded to the real backend.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._backend = None
+        self._lock = threading.Lock()
+        self.init_seconds = None
+
+    @property
+    def initialized(self):
+        return self._backend is not None
+
+    def get(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    start = time.perf_counter()
+                    backend = self._factory()
+                    self.init_seconds = time.perf_counter() - start
+                    logging.info(f"Initialized the {backend.name} LLM backend in {self.init_seconds * 1000:.1f} ms")
+                    self._backend = backend
+        return self._backend
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def create_backend(generation_config, fallback=False):
+    """Create the LLM backend selected by the LLM_BACKEND environment variable
+
+    With fallback, the faster and cheaper configuration used when the primary model
+    is slow or failing: GEMINI_FALLBACK_MODEL with at most LLM_FALLBACK_MAX_OUTPUT_TOKENS
+    tokens per answer, or a quicker stub.
+    """
+    backend = os.environ.get("LLM_BACKEND", "gemini").lower()
+
+    if backend == "stub":
+        if fallback:
+            return StubBackend(
+                latency=float(os.environ.get("STUB_LLM_FALLBACK_LATENCY", 0.1)),
+                output_words=int(os.environ.get("STUB_LLM_OUTPUT_WORDS", 200)) // 2,
+                chunk_words=int(os.environ.get("STUB_LLM_CHUNK_WORDS", 8))
+            )
+        logging.info("Using the offline stub LLM backend")
+        return StubBackend(
+            latency=float(os.environ.get("STUB_LLM_LATENCY", 0.5)),
+            output_words=int(os.environ.get("STUB_LLM_OUTPUT_WORDS", 200)),
+            chunk_words=int(os.environ.get("STUB_LLM_CHUNK_WORDS", 8)),
+            chunk_delay=float(os.environ.get("STUB_LLM_CHUNK_DELAY", 0.0)),
+            failure_rate=float(os.environ.get("STUB_LLM_FAILURE_RATE", 0.0)),
+            slow_rate=float(os.environ.get("STUB_LLM_SLOW_RATE", 0.0)),
+            slow_latency=float(os.environ.get("STUB_LLM_SLOW_LATENCY", 30))
+        )
+
+    if backend == "gemini":
+        if fallback:
+            generation_config = dict(
+                generation_config,
+                max_output_tokens=int(os.environ.get("LLM_FALLBACK_MAX_OUTPUT_TOKENS", 1024))
+            )
+        return GeminiBackend(
+            model_name=os.environ.get("GEMINI_FALLBACK_MODEL", "models/gemini-1.5-flash") if fallback
+                else os.environ.get("GEMINI_MODEL", "models/gemini-1.5-pro"),
+            generation_config=generation_config,
+            api_key=os.environ.get("GOOGLE_API_KEY"),
+            # GEMINI_TRANSPORT=rest is needed with gevent workers, since gRPC isn't green-thread safe
+            transport=os.environ.get("GEMINI_TRANSPORT"),
+            # Explicit context caching needs a versioned model name, e.g. models/gemini-1.5-pro-002
+            context_cache=os.environ.get("GEMINI_CONTEXT_CACHE", "false").lower() == "true",
+            context_cache_ttl=int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL", 3600)),
+            context_cache_min_tokens=int(os.environ.get("GEMINI_CONTEXT_CACHE_MIN_TOKENS", 32768)),
+            # Hard cap per request; the resilience layer gives up on calls much sooner
+            request_timeout=float(os.environ.get("LLM_REQUEST_TIMEOUT", 120))
+        )
+
+    raise ValueError(f"Unknown LLM_BACKEND: {backend}")
@@ -1,4 +1,12 @@
+import os
+
+# The development server logs at debug level unless told otherwise
+os.environ.setdefault("LOG_LEVEL", "DEBUG")
+
 from app import app
+from models import upgrade_schema
 
 if __name__ == "__main__":
+    with app.app_context():
+        upgrade_schema()
     app.run(host="0.0.0.0", port=5000, debug=True)
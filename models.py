@@ -1,14 +1,52 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
+
+from rendering import stored_html
+
+# Initialize SQLAlchemy without explicitly binding it to an app yet.
+# Objects aren't expired on commit so the request-scoped conversation isn't reloaded after each write.
+db = SQLAlchemy(session_options={"expire_on_commit": False})
+
+def upgrade_schema():
+    """Create missing tables, and add columns and indexes introduced after a table was created
+
+    db.create_all() only creates tables that don't exist yet, so columns added to a model
+    later are added here with ALTER TABLE. New columns must therefore be nullable.
+    """
+    db.create_all()
+    
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    connection.execute(text(
+                        f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column.name)} {column_type}"
+                    ))
+            
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection)
+        
+        # The full-text search index is database-specific, so it's created with raw DDL
+        from search import create_search_index
+        create_search_index(connection)
 
-# Initialize SQLAlchemy without explicitly binding it to an app yet
-db = SQLAlchemy()
 
 class Conversation(db.Model):
     """Model for storing conversation sessions"""
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(255), unique=True, nullable=False)
     persona = db.Column(db.String(50), nullable=True)
+    # Rolling summary of the messages that no longer fit in the prompt's context budget
+    summary = db.Column(db.Text, nullable=True)
+    summary_until = db.Column(db.Integer, nullable=True)  # ID of the last message folded into the summary
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -25,15 +63,80 @@ class Message(db.Model):
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False)
     role = db.Column(db.String(20), nullable=False)  # 'user' or 'assistant'
     content = db.Column(db.Text, nullable=False)
+    content_html = db.Column(db.Text, nullable=True)  # Server-rendered Markdown, see rendering.py
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # History is always read per conversation in timestamp order
+    __table_args__ = (
+        db.Index('ix_message_conversation_timestamp', 'conversation_id', 'timestamp'),
+    )
+    
     def __repr__(self):
         return f'<Message {self.id}: {self.role[:10]}...>'
     
-    def to_dict(self):
-        """Convert message to dictionary format for the UI"""
-        return {
+    def to_dict(self, html=False):
+        """Convert message to dictionary format for the UI
+
+        With html, the stored rendering of the content is included as 'html' (None
+        when there is none, in which case the client renders the Markdown itself).
+        """
+        message = {
+            'id': self.id,
             'role': self.role,
             'content': self.content,
             'timestamp': self.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        }
\ No newline at end of file
+        }
+        if html:
+            message['html'] = stored_html(self.content_html)
+        return message
+
+
+class CachedResponse(db.Model):
+    """Model for the response cache shared between workers"""
+    key = db.Column(db.String(64), primary_key=True)  # SHA-256 fingerprint of the prompt
+    response = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<CachedResponse {self.key[:12]}...>'
+
+
+class SessionData(db.Model):
+    """Model for server-side Flask session data"""
+    sid = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)  # JSON-serialized session contents
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<SessionData {self.sid[:8]}...>'
+
+
+class InflightCall(db.Model):
+    """Model for the lock table that coalesces identical LLM calls across workers
+
+    The worker holding a key's row makes the call and publishes the response text as
+    it arrives; other workers poll the row instead of calling the LLM themselves.
+    """
+    key = db.Column(db.String(64), primary_key=True)  # SHA-256 fingerprint of the final prompt
+    content = db.Column(db.Text, nullable=False, default='')
+    done = db.Column(db.Boolean, nullable=False, default=False)
+    degraded = db.Column(db.Boolean, nullable=True)  # Answered by the fallback model, see resilience.py
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<InflightCall {self.key[:12]}...>'
+
+
+class RateLimitBucket(db.Model):
+    """Model for the token buckets of the rate limiter shared between workers
+
+    Times are Unix timestamps, so buckets refill at the same pace in every worker.
+    """
+    key = db.Column(db.String(255), primary_key=True)  # Bucket name and session ID or client IP
+    tokens = db.Column(db.Float, nullable=False)
+    updated = db.Column(db.Float, nullable=False)  # Time of the last take, also used for compare-and-set
+    expires_at = db.Column(db.Float, nullable=False, index=True)  # When the bucket is full again
+    
+    def __repr__(self):
+        return f'<RateLimitBucket {self.key}: {self.tokens:.1f}>'
@@ -0,0 +1,239 @@
+import math
+import time
+import logging
+import threading
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, RateLimitBucket
+
+
+class BucketLimit:
+    """Size and refill rate of a token bucket"""
+
+    def __init__(self, capacity, per_minute):
+        self.capacity = capacity
+        self.per_minute = per_minute
+        self.rate = per_minute / 60
+
+    def refill(self, tokens, updated, now):
+        return min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+
+    def seconds_until(self, tokens, wanted):
+        """Seconds until the bucket holds wanted tokens again"""
+        if tokens >= wanted:
+            return 0.0
+        return (wanted - tokens) / self.rate if self.rate > 0 else math.inf
+
+
+def _take(limit, tokens, cost, force):
+    """New bucket level after taking cost tokens, or None if there aren't enough
+
+    A cost larger than the bucket can't be refused forever, so it only needs a full
+    bucket. Forced takes (and refunds, with a negative cost) always go through, but
+    never leave more than a bucket of debt.
+    """
+    if not force and tokens < min(cost, limit.capacity):
+        return None
+    return min(limit.capacity, max(tokens - cost, -limit.capacity))
+
+
+class MemoryBucketStore:
+    """Token buckets in this worker's memory; each gunicorn worker has its own"""
+
+    def __init__(self, prune_every=1000):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._prune_every = prune_every
+        self._calls = 0
+
+    def take(self, key, cost, limit, force=False):
+        """Take cost tokens from a bucket. Returns (allowed, tokens left)"""
+        now = time.time()
+        with self._lock:
+            self._calls += 1
+            if self._calls % self._prune_every == 0:
+                self._prune(now)
+
+            stored = self._buckets.get(key)
+            tokens = limit.refill(*stored[:2], now) if stored else limit.capacity
+            remaining = _take(limit, tokens, cost, force)
+            if remaining is None:
+                return False, tokens
+            self._buckets[key] = (remaining, now, limit)
+            return True, remaining
+
+    def _prune(self, now):
+        # A bucket that has refilled completely is the same as no bucket
+        full = [
+            key for key, (tokens, updated, limit) in self._buckets.items()
+            if limit.refill(tokens, updated, now) >= limit.capacity
+        ]
+        for key in full:
+            del self._buckets[key]
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'buckets': len(self._buckets)}
+
+
+class DatabaseBucketStore:
+    """Token buckets in the rate_limit_bucket table, shared by all workers
+
+    Updates are compare-and-set on the row's last update time, so concurrent takes
+    from several workers are retried instead of overwriting each other. A row
+    expires once its bucket would be full again and is swept every sweep_every takes.
+    """
+
+    def __init__(self, retries=5, sweep_every=1000):
+        self.retries = retries
+        self.sweep_every = sweep_every
+        self._calls = 0
+        self._lock = threading.Lock()
+
+    def take(self, key, cost, limit, force=False):
+        """Take cost tokens from a bucket. Returns (allowed, tokens left)"""
+        self._maybe_sweep()
+        for _ in range(self.retries):
+            now = time.time()
+            try:
+                with db.engine.begin() as connection:
+                    row = connection.execute(
+                        select(RateLimitBucket.tokens, RateLimitBucket.updated).where(RateLimitBucket.key == key)
+                    ).first()
+                    tokens = limit.refill(row.tokens, row.updated, now) if row else limit.capacity
+                    remaining = _take(limit, tokens, cost, force)
+                    if remaining is None:
+                        return False, tokens
+
+                    values = dict(
+                        tokens=remaining,
+                        updated=now,
+                        expires_at=now + limit.seconds_until(remaining, limit.capacity)
+                    )
+                    if row is None:
+                        connection.execute(insert(RateLimitBucket).values(key=key, **values))
+                        return True, remaining
+                    result = connection.execute(
+                        update(RateLimitBucket)
+                        .where(RateLimitBucket.key == key, RateLimitBucket.updated == row.updated)
+                        .values(**values)
+                    )
+                    if result.rowcount == 1:
+                        return True, remaining
+            except IntegrityError:
+                pass  # Another worker created the bucket first
+        raise RuntimeError(f"Rate limit bucket {key} is too contended")
+
+    def _maybe_sweep(self):
+        with self._lock:
+            self._calls += 1
+            sweep = self._calls % self.sweep_every == 0
+        if sweep:
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Error sweeping rate limit buckets: {str(e)}")
+
+    def sweep(self):
+        """Delete buckets that have refilled completely, returning how many were removed"""
+        with db.engine.begin() as connection:
+            result = connection.execute(delete(RateLimitBucket).where(RateLimitBucket.expires_at <= time.time()))
+        return result.rowcount
+
+    def stats(self):
+        return {'backend': 'database'}
+
+
+class RateLimitResult:
+    """Outcome of a rate limit check, and the bucket to report in the RateLimit headers"""
+
+    def __init__(self, allowed, name, limit, remaining, retry_after=0.0):
+        self.allowed = allowed
+        self.name = name
+        self.limit = limit
+        self.remaining = remaining
+        self.retry_after = retry_after
+
+    def headers(self):
+        headers = {
+            'RateLimit-Policy': f'{self.name};q={self.limit.capacity};w=60',
+            'RateLimit-Limit': str(self.limit.capacity),
+            'RateLimit-Remaining': str(max(0, math.floor(self.remaining))),
+            'RateLimit-Reset': str(math.ceil(self.limit.seconds_until(self.remaining, self.limit.capacity))),
+        }
+        if not self.allowed:
+            headers['Retry-After'] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+class RateLimiter:
+    """Token-bucket rate limits on requests and estimated LLM tokens
+
+    limits maps a bucket name, such as 'session_requests' or 'ip_tokens', to a
+    BucketLimit. A request is checked against one bucket per name, keyed by the
+    session ID or client IP, and is allowed only if every bucket has enough tokens;
+    buckets already taken from are refunded when a later one refuses.
+
+    When the store fails (the database is down), requests are let through rather
+    than rejected, and counted as errors.
+    """
+
+    def __init__(self, store, limits, rejected_counter=None):
+        self.store = store
+        self.limits = limits
+        self.rejected_counter = rejected_counter
+        self.counters = {'allowed': 0, 'rejected': 0, 'errors': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def check(self, charges):
+        """Take tokens for a request; charges is a list of (bucket name, key, cost)
+
+        Returns a RateLimitResult, for the bucket that refused the request or else
+        the one closest to running out.
+        """
+        taken = []
+        tightest = None
+        try:
+            for name, key, cost in charges:
+                limit = self.limits[name]
+                allowed, remaining = self.store.take(f"{name}:{key}", cost, limit)
+                if not allowed:
+                    for taken_name, taken_key, taken_cost in taken:
+                        self.store.take(f"{taken_name}:{taken_key}", -taken_cost, self.limits[taken_name], force=True)
+                    self._count('rejected')
+                    if self.rejected_counter is not None:
+                        self.rejected_counter.inc(bucket=name)
+                    retry_after = limit.seconds_until(remaining, min(cost, limit.capacity))
+                    return RateLimitResult(False, name, limit, remaining, retry_after)
+
+                taken.append((name, key, cost))
+                if tightest is None or remaining / limit.capacity < tightest.remaining / tightest.limit.capacity:
+                    tightest = RateLimitResult(True, name, limit, remaining)
+        except Exception as e:
+            logging.error(f"Error checking rate limits: {str(e)}")
+            self._count('errors')
+            return None
+
+        self._count('allowed')
+        return tightest
+
+    def charge(self, name, key, cost):
+        """Take (or with a negative cost, give back) tokens after the fact, e.g. once
+        the actual size of an LLM call is known. Never refused."""
+        try:
+            self.store.take(f"{name}:{key}", cost, self.limits[name], force=True)
+        except Exception as e:
+            logging.error(f"Error charging rate limit bucket: {str(e)}")
+            self._count('errors')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats.update(self.store.stats())
+        return stats
@@ -0,0 +1,45 @@
+from html import escape
+
+from markdown_it import MarkdownIt
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
+
+# Bump when the rendering below changes, so HTML stored by an older version is rendered again
+RENDER_VERSION = 1
+VERSION_MARKER = f"<!--md:{RENDER_VERSION}-->"
+
+_formatter = HtmlFormatter(nowrap=True)
+
+
+def _highlight_code(code, lang, attrs):
+    """Syntax-highlight a fenced code block with Pygments (styles in static/css/pygments.css)"""
+    try:
+        lexer = get_lexer_by_name(lang) if lang else None
+    except ClassNotFound:
+        lexer = None
+    if lexer is None:
+        return ""  # markdown-it escapes the code and wraps it itself
+    return f'<pre class="highlight"><code class="language-{escape(lang)}">{highlight(code, lexer, _formatter)}</code></pre>'
+
+
+# Same options as the markdown-it instance in static/js/chat.js; raw HTML in messages is escaped
+_markdown = MarkdownIt("js-default", {
+    "html": False,
+    "linkify": True,
+    "typographer": True,
+    "highlight": _highlight_code,
+})
+
+
+def render_markdown(text):
+    """Render a message's Markdown to HTML for storing in Message.content_html"""
+    return VERSION_MARKER + _markdown.render(text)
+
+
+def stored_html(content_html):
+    """The HTML of a stored rendering, or None if it's missing or from an older renderer"""
+    if not content_html or not content_html.startswith(VERSION_MARKER):
+        return None
+    return content_html[len(VERSION_MARKER):]
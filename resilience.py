@@ -0,0 +1,337 @@
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# HTTP status codes (also used by google.api_core exceptions) of errors worth retrying
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class LLMUnavailableError(Exception):
+    """No answer could be generated within the deadline, or the circuit breaker is open"""
+
+
+class DegradedText(str):
+    """Response text generated by the fallback model, which shouldn't be cached"""
+
+
+def is_transient(error):
+    """Whether an LLM error is likely to go away when the call is retried"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, 'code', None)
+    return isinstance(code, int) and code in TRANSIENT_STATUS_CODES
+
+
+class CircuitBreaker:
+    """Stops calling the primary model after repeated failures
+
+    After failure_threshold failures in a row the circuit opens and calls fail fast
+    (or go to the fallback model) for cooldown seconds. Then a single probe call is
+    let through: if it succeeds the circuit closes again, otherwise it stays open for
+    another cooldown. Only transient failures should be recorded; errors caused by
+    the request itself say nothing about the model's health.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, cooldown=30, transition_counter=None):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.transition_counter = transition_counter
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            logging.warning(f"LLM circuit breaker {self.state} -> {state}")
+            self.state = state
+            if self.transition_counter is not None:
+                self.transition_counter.inc(state=state)
+
+    def allow(self):
+        """Whether a call to the primary model may be made now"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self._set_state(self.HALF_OPEN)
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._set_state(self.CLOSED)
+
+    def record_ignored(self):
+        """A call ended with an error that doesn't count either way; lets another probe through"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures}
+
+
+class ResilientBackend:
+    """Wraps an LLM backend with deadlines, retries, hedging, a circuit breaker and a fallback
+
+    Every call runs in a worker thread so that it can be given up on:
+
+    - Each attempt may take attempt_timeout seconds, and the whole call deadline
+      seconds. Past the deadline LLMUnavailableError is raised; the abandoned
+      attempt finishes in the background (the backend's own request timeout ends it).
+    - Transient errors (timeouts, connection errors, 429 and 5xx) are retried up to
+      retries times, after a random "full jitter" backoff.
+    - With hedging, a second identical request is sent when the first hasn't
+      answered after hedge_delay seconds (by default the recent p95 latency); the
+      first answer wins.
+    - Transient failures and timed-out attempts count towards the circuit breaker;
+      other errors (e.g. a prompt blocked by the safety filters) are the request's
+      fault and don't. While it is open, calls go straight to the fallback backend,
+      or fail fast without one.
+    - If the primary model hasn't answered after fallback_after seconds, or has
+      failed for good, the fallback backend (a faster, cheaper model configuration)
+      is asked as well. Its answers are returned as DegradedText.
+
+    Streams are handled the same way up to their first chunk; once a chunk has been
+    sent the stream can't be retried. Attribute access is forwarded to the primary
+    backend.
+    """
+
+    def __init__(self, primary, fallback=None, deadline=60, attempt_timeout=30, retries=2,
+                 retry_base_delay=0.5, retry_max_delay=4, hedge=False, hedge_delay=None,
+                 fallback_after=20, breaker=None, attempt_counter=None, max_workers=64):
+        self.primary = primary
+        self.fallback = fallback
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.retries = retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.fallback_after = fallback_after
+        self.breaker = breaker or CircuitBreaker()
+        self.attempt_counter = attempt_counter
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='llm')
+        self._latencies = deque(maxlen=200)  # Recent successful primary call latencies
+        self._lock = threading.Lock()
+        self.counters = {'calls': 0, 'retries': 0, 'hedges': 0, 'hedges_won': 0, 'fallbacks': 0,
+                         'fallbacks_won': 0, 'timeouts': 0, 'failures': 0, 'rejected': 0}
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    def register_system_prompts(self, system_prompts):
+        self.primary.register_system_prompts(system_prompts)
+        if self.fallback is not None:
+            self.fallback.register_system_prompts(system_prompts)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _record_attempt(self, model, attempt, outcome):
+        if self.attempt_counter is not None:
+            self.attempt_counter.inc(model=model, attempt=attempt, outcome=outcome)
+
+    def latency_p95(self):
+        """p95 latency of recent primary calls, or None before there are enough of them"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < 20:
+            return None
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    def _backoff(self, retry):
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** retry))
+
+    def _execute(self, operation, discard=None):
+        """Run operation(backend) with retries, hedging and fallback
+
+        Returns the first result and which model produced it, 'primary' or 'fallback'.
+
+        discard is called with the results of attempts that lost the race, e.g. to
+        close their streams.
+        """
+        self._count('calls')
+        started = time.monotonic()
+        deadline = started + self.deadline
+        attempts = {}  # future -> (model, attempt, start time)
+        retries_left = self.retries
+        retry_at = None
+        fallback_started = False
+        last_error = None
+
+        def launch(model, attempt):
+            nonlocal fallback_started
+            backend = self.primary if model == 'primary' else self.fallback
+            if model == 'fallback':
+                fallback_started = True
+                self._count('fallbacks')
+            attempts[self._pool.submit(operation, backend)] = (model, attempt, time.monotonic())
+
+        def abandon(future):
+            # The result of an attempt nobody waits for any more is thrown away
+            if discard is not None:
+                future.add_done_callback(lambda f: f.exception() is None and discard(f.result()))
+
+        if self.breaker.allow():
+            launch('primary', 'first')
+            p95 = self.latency_p95() if self.hedge_delay is None else self.hedge_delay
+            hedge_at = started + p95 if self.hedge and p95 is not None else None
+            fallback_at = started + self.fallback_after if self.fallback is not None else None
+        elif self.fallback is not None:
+            launch('fallback', 'fallback')
+            hedge_at = fallback_at = None
+        else:
+            self._count('rejected')
+            raise LLMUnavailableError("The LLM circuit breaker is open")
+
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                wake_times = [deadline] + [t for t in (hedge_at, fallback_at, retry_at) if t is not None]
+                wake_times += [attempt_started + self.attempt_timeout for _, _, attempt_started in attempts.values()]
+                timeout = max(min(wake_times) - now, 0)
+                if attempts:
+                    done, _ = wait(list(attempts), timeout=timeout, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(timeout)
+                    done = set()
+
+                for future in done:
+                    model, attempt, attempt_started = attempts.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        elapsed = time.monotonic() - attempt_started
+                        self._record_attempt(model, attempt, 'ok')
+                        if model == 'primary':
+                            self.breaker.record_success()
+                            with self._lock:
+                                self._latencies.append(elapsed)
+                            if attempt == 'hedge':
+                                self._count('hedges_won')
+                        else:
+                            self._count('fallbacks_won')
+                        for other in attempts:
+                            self._record_attempt(attempts[other][0], attempts[other][1], 'lost')
+                            abandon(other)
+                        attempts.clear()
+                        return future.result(), model
+
+                    last_error = error
+                    self._count('failures')
+                    self._record_attempt(model, attempt, 'error')
+                    logging.warning(f"LLM {model} call failed: {str(error)}")
+                    if model == 'primary':
+                        if not is_transient(error):
+                            self.breaker.record_ignored()
+                        else:
+                            self.breaker.record_failure()
+                            if retries_left > 0 and retry_at is None:
+                                retries_left -= 1
+                                retry_at = time.monotonic() + self._backoff(self.retries - retries_left - 1)
+
+                now = time.monotonic()
+                # Attempts that ran out of time count as failures and may be retried
+                for future, (model, attempt, attempt_started) in list(attempts.items()):
+                    if now - attempt_started >= self.attempt_timeout:
+                        del attempts[future]
+                        abandon(future)
+                        self._count('timeouts')
+                        self._record_attempt(model, attempt, 'timeout')
+                        last_error = TimeoutError(f"LLM {model} call took longer than {self.attempt_timeout}s")
+                        if model == 'primary':
+                            self.breaker.record_failure()
+                            if retries_left > 0 and retry_at is None:
+                                retries_left -= 1
+                                retry_at = now
+
+                if hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if attempts and self.breaker.state == CircuitBreaker.CLOSED:
+                        self._count('hedges')
+                        launch('primary', 'hedge')
+                if retry_at is not None and now >= retry_at:
+                    retry_at = None
+                    if self.breaker.allow():
+                        self._count('retries')
+                        launch('primary', 'retry')
+                if fallback_at is not None and now >= fallback_at:
+                    fallback_at = None
+                    if not fallback_started:
+                        launch('fallback', 'fallback')
+
+                if not attempts and retry_at is None:
+                    # The primary model has failed for good: ask the fallback right away
+                    if self.fallback is not None and not fallback_started:
+                        fallback_at = None
+                        launch('fallback', 'fallback')
+                    else:
+                        break
+        finally:
+            for future in attempts:
+                abandon(future)
+
+        if time.monotonic() >= deadline:
+            self._count('timeouts')
+            raise LLMUnavailableError(f"No LLM response within {self.deadline}s") from last_error
+        raise LLMUnavailableError(f"The LLM call failed: {str(last_error)}") from last_error
+
+    def generate(self, prompt, system=None):
+        text, model = self._execute(lambda backend: backend.generate(prompt, system=system))
+        return DegradedText(text) if model == 'fallback' else text
+
+    def stream(self, prompt, system=None):
+        def open_stream(backend):
+            # An attempt is done once the stream has produced its first chunk
+            chunks = iter(backend.stream(prompt, system=system))
+            return chunks, next(chunks, None)
+
+        def close_stream(result):
+            chunks, _ = result
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+        (chunks, first), model = self._execute(open_stream, discard=close_stream)
+        wrap = DegradedText if model == 'fallback' else str
+        try:
+            if first is not None:
+                yield wrap(first)
+            for chunk in chunks:
+                yield wrap(chunk)
+        finally:
+            close_stream((chunks, first))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['breaker'] = self.breaker.stats()
+        p95 = self.latency_p95()
+        stats['latency_p95'] = round(p95, 3) if p95 is not None else None
+        stats['fallback'] = self.fallback is not None
+        return stats
@@ -0,0 +1,226 @@
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, or_, and_, select, text
+
+from models import db, Conversation, Message, CachedResponse, InflightCall
+from transfer import export_lines, gzip_chunks
+
+JOURNAL_NAME = "retention-journal.ndjson"
+
+
+class RetentionPolicy:
+    """Which conversations are old enough to be archived and removed
+
+    A conversation is expired when it hasn't been updated for idle_days. Abandoned
+    sessions, whose conversation has at most short_max_messages messages, already
+    expire after short_idle_days (if set).
+    """
+
+    def __init__(self, idle_days=30, short_idle_days=None, short_max_messages=2):
+        self.idle_days = idle_days
+        self.short_idle_days = short_idle_days
+        self.short_max_messages = short_max_messages
+
+    def cutoffs(self, now=None):
+        now = now or datetime.utcnow()
+        short_cutoff = now - timedelta(days=self.short_idle_days) if self.short_idle_days is not None else None
+        return now - timedelta(days=self.idle_days), short_cutoff
+
+    def condition(self, idle_cutoff, short_cutoff):
+        """SQL condition selecting the expired conversations"""
+        condition = Conversation.updated_at < idle_cutoff
+        if short_cutoff is not None and short_cutoff > idle_cutoff:
+            message_count = (
+                select(func.count(Message.id))
+                .where(Message.conversation_id == Conversation.id)
+                .scalar_subquery()
+            )
+            condition = or_(condition, and_(
+                Conversation.updated_at < short_cutoff,
+                message_count <= self.short_max_messages
+            ))
+        return condition
+
+    def describe(self):
+        description = f"idle for {self.idle_days} days"
+        if self.short_idle_days is not None:
+            description += f", or {self.short_idle_days} days with at most {self.short_max_messages} messages"
+        return description
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+class ConversationArchiver:
+    """Moves expired conversations into gzipped NDJSON archive files
+
+    Conversations are processed in batches of batch_size, in id order. Each batch is
+    streamed from the database (yield_per, so at most a chunk of rows is in memory),
+    written to its own archive file and only then deleted with two bulk deletes.
+    The files use the export format of transfer.export_lines, so an archive can be
+    restored with `flask --app app import-conversations`.
+
+    The runs are recorded in a journal in the archive directory. A batch whose file
+    was written but whose delete didn't happen (the job was killed, the database
+    went away) is deleted first on the next run, so an interrupted run can simply be
+    started again. Conversations that were used again after being archived are
+    never deleted.
+    """
+
+    def __init__(self, policy, archive_dir, batch_size=500, chunk_size=1000):
+        self.policy = policy
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.archive_dir, JOURNAL_NAME)
+
+    def _journal(self, entry):
+        with open(self.journal_path, "a") as f:
+            f.write(json.dumps(entry, default=_json_default) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _unfinished_batches(self):
+        """Batches that were archived but never deleted, from the journal"""
+        if not os.path.exists(self.journal_path):
+            return []
+        archived = {}
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short when the job died
+                if entry.get("event") == "archived":
+                    archived[entry["file"]] = entry
+                elif entry.get("event") == "deleted":
+                    archived.pop(entry["file"], None)
+        return list(archived.values())
+
+    def report(self):
+        """Dry run: what a run would archive, without writing or deleting anything"""
+        idle_cutoff, short_cutoff = self.policy.cutoffs()
+        expired = select(Conversation.id).where(self.policy.condition(idle_cutoff, short_cutoff)).subquery()
+        with db.engine.connect() as connection:
+            conversations, oldest = connection.execute(
+                select(func.count(Conversation.id), func.min(Conversation.updated_at))
+                .where(Conversation.id.in_(select(expired.c.id)))
+            ).one()
+            messages, content_bytes = connection.execute(
+                select(func.count(Message.id), func.coalesce(func.sum(func.length(Message.content)), 0))
+                .where(Message.conversation_id.in_(select(expired.c.id)))
+            ).one()
+            total_conversations = connection.execute(select(func.count(Conversation.id))).scalar()
+        return {
+            'policy': self.policy.describe(),
+            'idle_cutoff': idle_cutoff,
+            'short_idle_cutoff': short_cutoff,
+            'conversations': conversations,
+            'total_conversations': total_conversations,
+            'messages': messages,
+            'content_bytes': int(content_bytes),
+            'oldest_updated_at': oldest,
+            'unfinished_batches': len(self._unfinished_batches()),
+        }
+
+    def _delete_batch(self, ids, cutoff):
+        """Bulk-delete archived conversations that haven't been used since they were archived"""
+        still_expired = select(Conversation.id).where(Conversation.id.in_(ids), Conversation.updated_at < cutoff)
+        with db.engine.begin() as connection:
+            messages = connection.execute(
+                delete(Message).where(Message.conversation_id.in_(still_expired))
+            ).rowcount
+            conversations = connection.execute(
+                delete(Conversation).where(Conversation.id.in_(ids), Conversation.updated_at < cutoff)
+            ).rowcount
+        return conversations, messages
+
+    def _write_batch(self, ids, path):
+        """Stream a batch of conversations and their messages into an archive file"""
+        partial_path = path + ".partial"
+        counts = {}
+        with db.engine.connect() as connection, open(partial_path, "wb") as f:
+            lines = export_lines(connection, Conversation.id.in_(ids), self.chunk_size, counts)
+            for chunk in gzip_chunks(lines):
+                f.write(chunk)
+        # The file only gets its final name once it's complete
+        os.replace(partial_path, path)
+        return counts['messages']
+
+    def run(self, max_batches=None):
+        """Archive and delete expired conversations, returning a summary of the run"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        totals = {'conversations': 0, 'messages': 0, 'files': [], 'resumed': 0}
+
+        # Finish the deletes of an interrupted run before starting new batches
+        for entry in self._unfinished_batches():
+            conversations, messages = self._delete_batch(entry["ids"], datetime.fromisoformat(entry["cutoff"]))
+            self._journal({'event': 'deleted', 'file': entry["file"], 'conversations': conversations})
+            logging.info(f"Finished interrupted batch {entry['file']}: deleted {conversations} conversations")
+            totals['resumed'] += 1
+            totals['conversations'] += conversations
+            totals['messages'] += messages
+
+        idle_cutoff, short_cutoff = self.policy.cutoffs()
+        condition = self.policy.condition(idle_cutoff, short_cutoff)
+        # A conversation touched after the newest cutoff is never deleted
+        delete_cutoff = max(idle_cutoff, short_cutoff or idle_cutoff)
+        run_id = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        last_id = 0
+        batch = 0
+        while max_batches is None or batch < max_batches:
+            with db.engine.connect() as connection:
+                ids = connection.execute(
+                    select(Conversation.id)
+                    .where(condition, Conversation.id > last_id)
+                    .order_by(Conversation.id)
+                    .limit(self.batch_size)
+                ).scalars().all()
+            if not ids:
+                break
+            last_id = ids[-1]
+            batch += 1
+
+            filename = f"conversations-{run_id}-{batch:05d}.ndjson.gz"
+            messages = self._write_batch(ids, os.path.join(self.archive_dir, filename))
+            self._journal({'event': 'archived', 'file': filename, 'ids': ids, 'cutoff': delete_cutoff, 'messages': messages})
+
+            conversations, deleted_messages = self._delete_batch(ids, delete_cutoff)
+            self._journal({'event': 'deleted', 'file': filename, 'conversations': conversations})
+            logging.info(f"Archived {len(ids)} conversations to {filename}, deleted {conversations}")
+
+            totals['files'].append(filename)
+            totals['conversations'] += conversations
+            totals['messages'] += deleted_messages
+        return totals
+
+
+def purge_expired_rows():
+    """Delete expired response cache and in-flight call rows, returning how many were removed"""
+    now = datetime.utcnow()
+    with db.engine.begin() as connection:
+        cached = connection.execute(delete(CachedResponse).where(CachedResponse.expires_at <= now)).rowcount
+        inflight = connection.execute(delete(InflightCall).where(InflightCall.expires_at <= now)).rowcount
+    return {'cached_responses': cached, 'inflight_calls': inflight}
+
+
+def compact_database():
+    """Give the space freed by deleted rows back and refresh the planner's statistics"""
+    dialect = db.engine.dialect.name
+    # VACUUM can't run inside a transaction
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if dialect == "sqlite":
+            connection.execute(text("VACUUM"))
+            connection.execute(text("ANALYZE"))
+        elif dialect == "postgresql":
+            for table in ("message", "conversation"):
+                connection.execute(text(f"VACUUM ANALYZE {table}"))
@@ -0,0 +1,88 @@
+"""Benchmark /api/chat throughput against gunicorn worker count using a slow stub LLM.
+
+Starts gunicorn once per (worker class, worker count) combination with LLM_BACKEND=stub
+answering after --latency seconds, fires --requests chat requests with --concurrency
+parallel clients and reports requests/sec.
+
+Usage:
+    python scripts/bench_concurrency.py --latency 1.0 --requests 200 --concurrency 50
+"""
+import time
+import json
+import argparse
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from benchutil import start_server, stop_server
+
+
+def send_chat(base_url):
+    request = urllib.request.Request(
+        base_url + "/api/chat",
+        data=json.dumps({"message": "What is recursion?", "persona": "code"}).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=120) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def run_case(worker_class, workers, args):
+    server, base_url = start_server(
+        {
+            "STUB_LLM_LATENCY": str(args.latency),
+            "LLM_MAX_IN_FLIGHT": str(args.concurrency),
+            "LLM_MAX_QUEUE": str(args.concurrency),
+        },
+        workers=workers,
+        worker_class=worker_class,
+        threads=args.threads,
+    )
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            statuses = list(pool.map(lambda _: send_chat(base_url), range(args.requests)))
+        elapsed = time.perf_counter() - start
+    finally:
+        stop_server(server)
+
+    ok = statuses.count(200)
+    rejected = statuses.count(503)
+    return {
+        "worker_class": worker_class,
+        "workers": workers,
+        "ok": ok,
+        "rejected": rejected,
+        "errors": len(statuses) - ok - rejected,
+        "seconds": round(elapsed, 2),
+        "rps": round(ok / elapsed, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=1.0, help="stub LLM latency in seconds")
+    parser.add_argument("--requests", type=int, default=200, help="total chat requests per case")
+    parser.add_argument("--concurrency", type=int, default=50, help="parallel clients")
+    parser.add_argument("--threads", type=int, default=32, help="threads per gthread worker")
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    parser.add_argument("--worker-classes", default="sync,gthread", help="comma-separated gunicorn worker classes")
+    args = parser.parse_args()
+
+    print(f"{'worker class':<14}{'workers':>8}{'ok':>6}{'503':>6}{'errors':>8}{'seconds':>9}{'req/s':>9}")
+    for worker_class in args.worker_classes.split(","):
+        for workers in (int(w) for w in args.workers.split(",")):
+            result = run_case(worker_class, workers, args)
+            print(f"{result['worker_class']:<14}{result['workers']:>8}{result['ok']:>6}{result['rejected']:>6}"
+                  f"{result['errors']:>8}{result['seconds']:>9}{result['rps']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark /api/search query latency on a large message table.
+
+Fills a throwaway SQLite database (or the database in DATABASE_URL, which should be
+empty) with --messages generated messages spread over --conversations conversations,
+letting the full-text index be maintained as the rows are inserted, then times
+--queries searches in random conversations through search_messages and reports
+p50/p95/p99 in milliseconds, for a common and a rare search term.
+
+Usage:
+    python scripts/bench_search.py --messages 1000000 --conversations 20000
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import argparse
+
+from benchutil import ROOT, percentile
+
+WORDS = (
+    "recursion function variable loop array pointer class object method string integer "
+    "photosynthesis cell energy molecule atom electron reaction equation derivative integral "
+    "history empire revolution treaty economy market supply demand inflation poetry novel "
+    "grammar sentence paragraph essay argument evidence theory experiment hypothesis result"
+).split()
+
+
+def generate_message(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 60)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200000, help="messages to insert")
+    parser.add_argument("--conversations", type=int, default=4000, help="conversations to spread them over")
+    parser.add_argument("--queries", type=int, default=500, help="searches per search term")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'search.db')}")
+    os.environ.setdefault("LLM_BACKEND", "stub")
+    sys.path.insert(0, ROOT)
+
+    from datetime import datetime
+    from sqlalchemy import insert
+    from app import app
+    from models import db, upgrade_schema, Conversation, Message
+    from search import search_messages, has_search_index
+
+    rng = random.Random(42)
+    with app.app_context():
+        upgrade_schema()
+
+        start = time.perf_counter()
+        with db.engine.begin() as connection:
+            connection.execute(insert(Conversation), [
+                {"session_id": f"bench-{i}", "created_at": datetime.utcnow(), "updated_at": datetime.utcnow()}
+                for i in range(args.conversations)
+            ])
+            batch = []
+            for i in range(args.messages):
+                batch.append({
+                    "conversation_id": rng.randint(1, args.conversations),
+                    "role": "user" if i % 2 == 0 else "assistant",
+                    "content": generate_message(rng),
+                    "timestamp": datetime.utcnow(),
+                })
+                if len(batch) == 10000:
+                    connection.execute(insert(Message), batch)
+                    batch = []
+            if batch:
+                connection.execute(insert(Message), batch)
+        print(f"Inserted {args.messages} messages in {time.perf_counter() - start:.1f}s")
+
+        with db.engine.connect() as connection:
+            indexed = has_search_index(connection)
+            print(f"Full-text index: {'yes' if indexed else 'no (LIKE fallback)'}")
+            print(f"{'query':<24}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+            for query in ("recursion", "photosynthesis inflation"):
+                timings = []
+                for _ in range(args.queries):
+                    conversation_id = rng.randint(1, args.conversations)
+                    start = time.perf_counter()
+                    search_messages(connection, conversation_id, query, 21, indexed=indexed)
+                    timings.append((time.perf_counter() - start) * 1000)
+                print(f"{query:<24}{percentile(timings, 50):>9.2f}{percentile(timings, 95):>9.2f}{percentile(timings, 99):>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark chat latency with synchronous commits against write-behind persistence.
+
+Starts gunicorn once with WRITE_BEHIND=false and once with WRITE_BEHIND=true against
+an instant stub LLM, so the measured time is mostly database work. Each of
+--concurrency virtual users sends --turns chat messages in its own conversation and
+then reads its history back, which checks that no message was lost and that
+read-your-writes holds. Reports requests/sec and p50/p95/p99 chat latency.
+
+Point DATABASE_URL at Postgres to measure the setup this is meant for, e.g.
+    DATABASE_URL=postgresql://localhost/edubuddy_bench python scripts/bench_write_behind.py
+
+Usage:
+    python scripts/bench_write_behind.py --concurrency 20 --turns 10
+"""
+import os
+import time
+import json
+import argparse
+import http.cookiejar
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from benchutil import start_server, stop_server, percentile
+
+
+def run_user(base_url, turns):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    latencies = []
+    errors = 0
+    for turn in range(turns):
+        request = urllib.request.Request(
+            base_url + "/api/chat",
+            data=json.dumps({"message": f"Question {turn}: what is recursion?", "persona": "code"}).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        start = time.perf_counter()
+        try:
+            with opener.open(request, timeout=120) as response:
+                response.read()
+            latencies.append(time.perf_counter() - start)
+        except OSError:
+            errors += 1
+
+    # Read the history straight back: every message must be visible already
+    with opener.open(base_url + f"/api/history?limit={turns * 2}", timeout=120) as response:
+        history = json.loads(response.read())["history"]
+    missing = max(0, (turns - errors) * 2 - len(history))
+    return latencies, errors, missing
+
+
+def run_case(write_behind, args):
+    env = {
+        "STUB_LLM_LATENCY": "0",
+        "RESPONSE_CACHE_ENABLED": "false",
+        "WRITE_BEHIND": "true" if write_behind else "false",
+        "LLM_MAX_IN_FLIGHT": str(args.concurrency),
+        "LLM_MAX_QUEUE": str(args.concurrency),
+    }
+    if os.environ.get("DATABASE_URL"):
+        env["DATABASE_URL"] = os.environ["DATABASE_URL"]
+
+    # One worker, so each user's history read lands on the worker holding its queued messages
+    server, base_url = start_server(env, workers=1, threads=args.concurrency)
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda _: run_user(base_url, args.turns), range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+    finally:
+        stop_server(server)
+
+    latencies = [latency for user_latencies, _, _ in results for latency in user_latencies]
+    return {
+        "mode": "write-behind" if write_behind else "sync",
+        "requests": len(latencies),
+        "errors": sum(errors for _, errors, _ in results),
+        "missing": sum(missing for _, _, missing in results),
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50": percentile(latencies, 50) * 1000,
+        "p95": percentile(latencies, 95) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=20, help="parallel virtual users")
+    parser.add_argument("--turns", type=int, default=10, help="chat messages per user")
+    args = parser.parse_args()
+
+    print(f"{'mode':<14}{'requests':>9}{'errors':>8}{'missing':>9}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for write_behind in (False, True):
+        result = run_case(write_behind, args)
+        print(f"{result['mode']:<14}{result['requests']:>9}{result['errors']:>8}{result['missing']:>9}"
+              f"{result['rps']:>9}{result['p50']:>9.1f}{result['p95']:>9.1f}{result['p99']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Helpers shared by the load-test and benchmark scripts."""
+import os
+import sys
+import time
+import socket
+import tempfile
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(base_url, timeout=180):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base_url + "/", timeout=1)
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not start within {timeout}s")
+
+
+def start_server(env_overrides=None, workers=2, worker_class="gthread", threads=32):
+    """Start gunicorn on a free port against the offline stub LLM and a throwaway SQLite database
+
+    Returns (process, base_url). The response cache and single-flight are off, so every
+    request reaches the stub LLM. Any variable in env_overrides takes precedence, so a
+    DATABASE_URL or LLM_BACKEND from the caller is respected.
+    """
+    port = free_port()
+    db_dir = tempfile.mkdtemp(prefix="edubuddy-bench-")
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        WEB_CONCURRENCY=str(workers),
+        GUNICORN_WORKER_CLASS=worker_class,
+        # Gunicorn silently switches sync workers to gthread when threads > 1
+        GUNICORN_THREADS=str(threads if worker_class != "sync" else 1),
+        LLM_BACKEND="stub",
+        DATABASE_URL=f"sqlite:///{os.path.join(db_dir, 'bench.db')}",
+        # The throwaway database needs its tables; each worker creates them on import
+        SCHEMA_AUTO_UPGRADE="true",
+        # Every simulated user comes from 127.0.0.1
+        RATE_LIMIT_ENABLED="false",
+        # Simulated users ask the same questions, which would measure the cache, not the model
+        RESPONSE_CACHE_ENABLED="false",
+        # Identical concurrent questions would share one LLM call for the same reason
+        LLM_SINGLE_FLIGHT="false",
+    )
+    env.update(env_overrides or {})
+
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+         "--log-level", "warning", "app:app"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_ready(base_url)
+    except Exception:
+        stop_server(server)
+        raise
+    return server, base_url
+
+
+def stop_server(server):
+    server.terminate()
+    server.wait()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
@@ -0,0 +1,70 @@
+"""Check the number of SQL statements each chat API request issues.
+
+Runs the app in-process against the stub LLM and a throwaway SQLite database,
+counts the statements executed per request and exits non-zero if any request
+goes over its budget.
+
+Usage:
+    python scripts/check_query_budget.py
+"""
+import os
+import sys
+import tempfile
+
+from benchutil import ROOT
+
+# Budgets for a returning user whose conversation already exists. Every request
+# starts with loading the server-side session.
+QUERY_BUDGETS = {
+    "POST /api/chat": 6,         # session, conversation, recent history, then one transaction
+                                 # with two message inserts and the updated_at bump
+    "POST /api/chat/stream": 8,  # the same, plus the final content update and updated_at bump
+                                 # (responses streaming for over a second add periodic updates)
+    "GET /api/history": 3,       # session, conversation, messages
+    "POST /api/persona": 4,      # session, conversation, persona update, session fallback update
+}
+
+
+def main():
+    os.environ.setdefault("LLM_BACKEND", "stub")
+    os.environ["STUB_LLM_LATENCY"] = "0"
+    os.environ["RESPONSE_CACHE_ENABLED"] = "false"
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'budget.db')}"
+    os.environ["SCHEMA_AUTO_UPGRADE"] = "true"
+    sys.path.insert(0, ROOT)
+
+    from sqlalchemy import event
+    from app import app
+    from models import db
+
+    statements = []
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    client = app.test_client()
+    # Create the conversation and some history first
+    client.post("/api/chat", json={"message": "What is recursion?", "persona": "code"})
+
+    requests = {
+        "POST /api/chat": lambda: client.post("/api/chat", json={"message": "Show an example", "persona": "code"}),
+        "POST /api/chat/stream": lambda: client.post("/api/chat/stream", json={"message": "And another"}).get_data(),
+        "GET /api/history": lambda: client.get("/api/history"),
+        "POST /api/persona": lambda: client.post("/api/persona", json={"persona": "stem"}),
+    }
+
+    over_budget = False
+    for name, send in requests.items():
+        statements.clear()
+        send()
+        status = "ok" if len(statements) <= QUERY_BUDGETS[name] else "OVER BUDGET"
+        over_budget = over_budget or status != "ok"
+        print(f"{name:<24}{len(statements):>3} queries (budget {QUERY_BUDGETS[name]})  {status}")
+        if status != "ok":
+            for statement in statements:
+                print(f"    {' '.join(statement.split())[:120]}")
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
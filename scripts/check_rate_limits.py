@@ -0,0 +1,69 @@
+"""Check that the token estimate of a chat request is settled in the rate limit buckets.
+
+Runs the app in-process against the stub LLM and a throwaway SQLite database with
+the database bucket store (RATE_LIMIT_BACKEND=database), and exits non-zero if a
+session's token bucket doesn't end up charged with exactly the tokens of its LLM
+call, or if a response cache hit isn't refunded completely.
+
+Usage:
+    python scripts/check_rate_limits.py
+"""
+import os
+import re
+import sys
+import tempfile
+
+from benchutil import ROOT
+
+CAPACITY = 16000
+
+
+def main():
+    os.environ.setdefault("LLM_BACKEND", "stub")
+    os.environ["STUB_LLM_LATENCY"] = "0"
+    os.environ["RESPONSE_CACHE_ENABLED"] = "true"
+    os.environ["LLM_SINGLE_FLIGHT"] = "false"
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'ratelimit.db')}"
+    os.environ["SCHEMA_AUTO_UPGRADE"] = "true"
+    os.environ["RATE_LIMIT_ENABLED"] = "true"
+    os.environ["RATE_LIMIT_BACKEND"] = "database"
+    # A practically frozen bucket, so refills during the check don't blur the levels
+    os.environ["RATE_LIMIT_SESSION_TOKENS"] = "0.001"
+    os.environ["RATE_LIMIT_SESSION_TOKENS_BURST"] = str(CAPACITY)
+    sys.path.insert(0, ROOT)
+
+    from app import app, metrics, rate_limiter
+    from models import db, RateLimitBucket
+
+    def session_tokens(client):
+        client.post("/api/persona", json={"persona": "code"})
+        with client.session_transaction() as session:
+            session_id = session["session_id"]
+        client.post("/api/chat", json={"message": "What is recursion?"}).close()
+        with app.app_context():
+            return db.session.get(RateLimitBucket, f"session_tokens:{session_id}").tokens
+
+    def llm_tokens_used():
+        sums = re.findall(r'^edubuddy_llm_tokens_sum\{[^}]*\} (\S+)$', metrics.render(), re.M)
+        return sum(float(value) for value in sums)
+
+    failed = False
+
+    def check(name, level, expected):
+        nonlocal failed
+        ok = abs(level - expected) < 1
+        failed = failed or not ok
+        print(f"{name:<28}{level:>10.1f} tokens left (expected {expected:.1f})  {'ok' if ok else 'FAILED'}")
+
+    # The first ask calls the LLM and is charged what it used
+    check("LLM call", session_tokens(app.test_client()), CAPACITY - llm_tokens_used())
+    # The same first message from another session comes from the response cache for free
+    check("response cache hit", session_tokens(app.test_client()), CAPACITY)
+
+    errors = rate_limiter.stats()["errors"]
+    print(f"{'rate limiter errors':<28}{errors:>10}  {'ok' if not errors else 'FAILED'}")
+    sys.exit(1 if failed or errors else 0)
+
+
+if __name__ == "__main__":
+    main()
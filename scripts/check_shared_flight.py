@@ -0,0 +1,92 @@
+"""Check that fallback answers stay marked as such when coalesced across workers.
+
+Runs two SingleFlight instances against one SharedFlightTable in a throwaway SQLite
+database, standing in for two gunicorn workers. The first makes a slow call (and a
+slow stream) answered by the fallback model, the second makes the identical call
+while it is in flight, and the script exits non-zero if the second worker doesn't
+get a DegradedText back, as app.py relies on that to keep fallback answers out of
+the response cache.
+
+Usage:
+    python scripts/check_shared_flight.py
+"""
+import os
+import sys
+import time
+import tempfile
+import threading
+
+from benchutil import ROOT
+
+ANSWER = "The primary model is unavailable, here is a shorter answer."
+
+
+def main():
+    os.environ.setdefault("LLM_BACKEND", "stub")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'flight.db')}"
+    os.environ["SCHEMA_AUTO_UPGRADE"] = "true"
+    sys.path.insert(0, ROOT)
+
+    from app import app
+    from resilience import DegradedText
+    from singleflight import SharedFlightTable, SingleFlight
+
+    table = SharedFlightTable(poll_interval=0.02)
+    leader_worker = SingleFlight(shared=table)
+    follower_worker = SingleFlight(shared=table)
+
+    def degraded_call():
+        time.sleep(0.3)
+        return DegradedText(ANSWER)
+
+    def degraded_stream():
+        for word in ANSWER.split(" "):
+            time.sleep(0.03)
+            yield DegradedText(word + " ")
+
+    def in_app_context(fn):
+        def run():
+            with app.app_context():
+                fn()
+        return run
+
+    def follow(leader, follower):
+        """Start the leader in a thread, then run the follower once the call is in flight"""
+        thread = threading.Thread(target=in_app_context(leader))
+        thread.start()
+        time.sleep(0.1)
+        with app.app_context():
+            result = follower()
+        thread.join()
+        return result
+
+    failed = False
+
+    def check(name, parts, shared_before):
+        nonlocal failed
+        coalesced = follower_worker.stats()["shared_coalesced"] > shared_before
+        # app.py looks at the first chunk to tell whether a streamed answer is degraded
+        degraded = bool(parts) and all(isinstance(part, DegradedText) for part in parts)
+        ok = coalesced and degraded and ''.join(parts).strip() == ANSWER
+        failed = failed or not ok
+        print(f"{name:<10}coalesced={coalesced!s:<7}degraded={degraded!s:<7}{'ok' if ok else 'FAILED'}")
+
+    shared_before = follower_worker.stats()["shared_coalesced"]
+    result = follow(
+        lambda: leader_worker.call("call", degraded_call),
+        lambda: follower_worker.call("call", lambda: ANSWER),
+    )
+    check("call", [result], shared_before)
+
+    shared_before = follower_worker.stats()["shared_coalesced"]
+    chunks = follow(
+        lambda: list(leader_worker.stream("stream", degraded_stream)),
+        lambda: list(follower_worker.stream("stream", lambda: iter([ANSWER]))),
+    )
+    check("stream", chunks, shared_before)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Load test for the chat API against the offline stub LLM backend.
+
+Each virtual user keeps its own session cookie and loops over POST /api/chat,
+GET /api/history and, every --reset-every iterations, POST /api/reset. At the end
+the script prints p50/p95/p99 latency and throughput per endpoint.
+
+By default a gunicorn server is started with LLM_BACKEND=stub and a throwaway
+SQLite database; pass --url to target a server that is already running.
+
+Usage:
+    python scripts/loadtest.py --users 20 --duration 30 --latency 0.2
+    python scripts/loadtest.py --url http://127.0.0.1:5000 --users 50
+"""
+import json
+import time
+import random
+import argparse
+import threading
+import http.cookiejar
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+from benchutil import start_server, stop_server, percentile
+
+QUESTIONS = [
+    ("code", "debug", "Why does my recursive fibonacci function overflow the stack?"),
+    ("code", None, "What is the difference between a list and a tuple in Python?"),
+    ("stem", "formula", "Newton's laws of motion"),
+    ("stem", "quiz", "Photosynthesis"),
+    ("business", "case-studies", "Platform business models"),
+    ("general", "summary", "The French Revolution"),
+]
+
+
+class VirtualUser:
+    """A simulated student with its own session cookie"""
+
+    def __init__(self, base_url, results, lock):
+        self.base_url = base_url
+        self.results = results
+        self.lock = lock
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def call(self, endpoint, method="GET", payload=None):
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = urllib.request.Request(
+            self.base_url + endpoint,
+            data=data,
+            headers={"Content-Type": "application/json"},
+            method=method,
+        )
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=120) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except OSError:
+            status = None
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.results[endpoint].append((elapsed, status))
+
+    def run(self, deadline, reset_every):
+        iteration = 0
+        while time.monotonic() < deadline:
+            iteration += 1
+            persona, action, message = random.choice(QUESTIONS)
+            payload = {"message": message, "persona": persona}
+            if action:
+                payload["action"] = action
+
+            self.call("/api/chat", "POST", payload)
+            self.call("/api/history")
+            if reset_every and iteration % reset_every == 0:
+                self.call("/api/reset", "POST", {})
+
+
+def report(results, elapsed):
+    print(f"{'endpoint':<16}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    total = 0
+    for endpoint, samples in sorted(results.items()):
+        latencies = [latency * 1000 for latency, _ in samples]
+        errors = sum(1 for _, status in samples if status != 200)
+        total += len(samples)
+        print(f"{endpoint:<16}{len(samples):>9}{errors:>8}{len(samples) / elapsed:>9.1f}"
+              f"{percentile(latencies, 50):>9.1f}{percentile(latencies, 95):>9.1f}{percentile(latencies, 99):>9.1f}")
+    print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base URL of a running server (default: start one with the stub backend)")
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="test duration in seconds")
+    parser.add_argument("--reset-every", type=int, default=10, help="reset the conversation every N iterations (0 to disable)")
+    parser.add_argument("--latency", type=float, default=0.2, help="stub LLM latency in seconds")
+    parser.add_argument("--output-words", type=int, default=200, help="stub LLM response length in words")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers for the bundled server")
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.url
+    if not base_url:
+        server, base_url = start_server(
+            {"STUB_LLM_LATENCY": str(args.latency), "STUB_LLM_OUTPUT_WORDS": str(args.output_words)},
+            workers=args.workers,
+        )
+
+    results = defaultdict(list)
+    lock = threading.Lock()
+    try:
+        start = time.monotonic()
+        deadline = start + args.duration
+        threads = [
+            threading.Thread(target=VirtualUser(base_url, results, lock).run, args=(deadline, args.reset_every))
+            for _ in range(args.users)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+    finally:
+        if server:
+            stop_server(server)
+
+    report(results, elapsed)
+
+
+if __name__ == "__main__":
+    main()
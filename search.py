@@ -0,0 +1,216 @@
+import re
+import html
+import logging
+from datetime import datetime
+
+from sqlalchemy import text
+
+# Markers placed around matched terms by the database, replaced with <mark> tags after
+# the snippet has been HTML-escaped. Private-use characters never occur in messages.
+MATCH_START = "\ue000"
+MATCH_END = "\ue001"
+
+SNIPPET_WORDS = 16
+
+SQLITE_FTS_DDL = (
+    # External-content FTS5 index over message.content; conversation_id is indexed too so a
+    # search only has to intersect the term's postings with the conversation's
+    """CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+        content, conversation_id, content='message', content_rowid='id', tokenize='porter unicode61'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN
+        INSERT INTO message_fts(rowid, content, conversation_id) VALUES (new.id, new.content, new.conversation_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN
+        INSERT INTO message_fts(message_fts, rowid, content, conversation_id)
+        VALUES ('delete', old.id, old.content, old.conversation_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content ON message BEGIN
+        INSERT INTO message_fts(message_fts, rowid, content, conversation_id)
+        VALUES ('delete', old.id, old.content, old.conversation_id);
+        INSERT INTO message_fts(rowid, content, conversation_id) VALUES (new.id, new.content, new.conversation_id);
+    END""",
+)
+
+POSTGRES_FTS_DDL = (
+    # A generated column keeps the tsvector up to date on every insert and update
+    """ALTER TABLE message ADD COLUMN IF NOT EXISTS content_tsv tsvector
+        GENERATED ALWAYS AS (to_tsvector('english', content)) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_message_content_tsv ON message USING GIN (content_tsv)",
+)
+
+
+def create_search_index(connection):
+    """Create the full-text index for the connection's database, if it supports one
+
+    On SQLite an existing message table is indexed once when the FTS table is first
+    created; afterwards triggers keep the index in step with every insert, update and
+    delete. On Postgres the generated column is filled when it's added.
+    """
+    dialect = connection.dialect.name
+
+    if dialect == "sqlite":
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_fts'"
+        )).first()
+        try:
+            for statement in SQLITE_FTS_DDL:
+                connection.execute(text(statement))
+        except Exception as e:
+            # SQLite builds without FTS5 fall back to a LIKE scan
+            logging.warning(f"Full-text search index not available: {str(e)}")
+            return
+        if not exists:
+            connection.execute(text("INSERT INTO message_fts(message_fts) VALUES ('rebuild')"))
+
+    elif dialect == "postgresql":
+        for statement in POSTGRES_FTS_DDL:
+            connection.execute(text(statement))
+
+
+def has_search_index(connection):
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        return connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_fts'"
+        )).first() is not None
+    if dialect == "postgresql":
+        return connection.execute(text(
+            "SELECT 1 FROM information_schema.columns WHERE table_name = 'message' AND column_name = 'content_tsv'"
+        )).first() is not None
+    return False
+
+
+def build_fts5_query(query):
+    """Turn free text into an FTS5 query matching all of its words
+
+    Every word is quoted so FTS5 operators and punctuation in the input can't cause
+    syntax errors. Words are stemmed by the index's porter tokenizer, so "recursion"
+    also finds "recursive".
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words)
+
+
+def format_timestamp(value):
+    """Format a timestamp like Message.to_dict; SQLite returns raw SQL timestamps as strings"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def highlight(snippet):
+    """HTML-escape a snippet and turn the match markers into <mark> tags"""
+    return html.escape(snippet).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>")
+
+
+def _search_sqlite(connection, conversation_id, query, limit, offset):
+    fts_query = build_fts5_query(query)
+    if fts_query is None:
+        return []
+    # FTS5's bm25() reads the whole posting list of every search term to weigh it, which
+    # grows with the table. Instead the conversation's matches are ranked by a BM25-style
+    # score of how often the terms occur in each message (counted from the markers
+    # highlight() adds) relative to its length, which only touches the conversation's rows.
+    rows = connection.execute(text(
+        """WITH matches AS (
+               SELECT rowid AS id,
+                   (length(highlight(message_fts, 0, :start, :end)) - length(content)) / 2 AS hits,
+                   length(content) AS size,
+                   snippet(message_fts, 0, :start, :end, '…', :words) AS snippet
+               FROM message_fts
+               WHERE message_fts MATCH :match
+           )
+           SELECT m.id, m.role, m.timestamp, matches.snippet,
+               matches.hits * 2.2 / (matches.hits + 1.2 * (0.25 + 0.75 * matches.size / avg(matches.size) OVER ())) AS score
+           FROM matches JOIN message AS m ON m.id = matches.id
+           ORDER BY score DESC, m.id DESC
+           LIMIT :limit OFFSET :offset"""
+    ), {
+        'match': f'conversation_id : "{int(conversation_id)}" AND content : ({fts_query})',
+        'start': MATCH_START,
+        'end': MATCH_END,
+        'words': SNIPPET_WORDS,
+        'limit': limit,
+        'offset': offset,
+    }).all()
+    return [(row.id, row.role, row.timestamp, row.score, row.snippet) for row in rows]
+
+
+def _search_postgres(connection, conversation_id, query, limit, offset):
+    # Rank and page first, then build headlines only for the page's rows
+    rows = connection.execute(text(
+        """WITH q AS (SELECT websearch_to_tsquery('english', :query) AS query),
+           page AS (
+               SELECT m.id, m.role, m.timestamp, m.content, ts_rank_cd(m.content_tsv, q.query) AS rank
+               FROM message AS m, q
+               WHERE m.conversation_id = :conversation_id AND m.content_tsv @@ q.query
+               ORDER BY rank DESC, m.id DESC
+               LIMIT :limit OFFSET :offset
+           )
+           SELECT page.id, page.role, page.timestamp, page.rank,
+               ts_headline('english', page.content, q.query, :options) AS snippet
+           FROM page, q
+           ORDER BY page.rank DESC, page.id DESC"""
+    ), {
+        'query': query,
+        'conversation_id': conversation_id,
+        'options': f"StartSel={MATCH_START}, StopSel={MATCH_END}, MaxWords={SNIPPET_WORDS}, MinWords=5, MaxFragments=2",
+        'limit': limit,
+        'offset': offset,
+    }).all()
+    return [(row.id, row.role, row.timestamp, row.rank, row.snippet) for row in rows]
+
+
+def _like_snippet(content, words):
+    """Snippet around the first occurrence of any of the words, for the LIKE fallback"""
+    lowered = content.lower()
+    positions = [lowered.find(word.lower()) for word in words if word.lower() in lowered]
+    start = max(min(positions) - 60, 0) if positions else 0
+    snippet = content[start:start + 160]
+    for word in words:
+        snippet = re.sub(f"({re.escape(word)})", f"{MATCH_START}\\1{MATCH_END}", snippet, flags=re.IGNORECASE)
+    return ("…" if start else "") + snippet + ("…" if start + 160 < len(content) else "")
+
+
+def _search_like(connection, conversation_id, query, limit, offset):
+    words = re.findall(r"\w+", query)
+    if not words:
+        return []
+    conditions = " AND ".join(f"lower(content) LIKE :word{i}" for i in range(len(words)))
+    params = {f"word{i}": f"%{word.lower()}%" for i, word in enumerate(words)}
+    rows = connection.execute(text(
+        f"""SELECT id, role, timestamp, content FROM message
+            WHERE conversation_id = :conversation_id AND {conditions}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT :limit OFFSET :offset"""
+    ), dict(params, conversation_id=conversation_id, limit=limit, offset=offset)).all()
+    return [(row.id, row.role, row.timestamp, 0.0, _like_snippet(row.content, words)) for row in rows]
+
+
+def search_messages(connection, conversation_id, query, limit, offset=0, indexed=True):
+    """Search a conversation's messages, best matches first
+
+    Returns a list of dicts with the message's id, role and timestamp, a relevance
+    score and an HTML snippet with the matched terms in <mark> tags.
+    """
+    dialect = connection.dialect.name
+    if indexed and dialect == "sqlite":
+        rows = _search_sqlite(connection, conversation_id, query, limit, offset)
+    elif indexed and dialect == "postgresql":
+        rows = _search_postgres(connection, conversation_id, query, limit, offset)
+    else:
+        rows = _search_like(connection, conversation_id, query, limit, offset)
+
+    return [
+        {
+            'id': message_id,
+            'role': role,
+            'timestamp': format_timestamp(timestamp),
+            'score': round(float(score), 4),
+            'snippet': highlight(snippet or ''),
+        }
+        for message_id, role, timestamp, score, snippet in rows
+    ]
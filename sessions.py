@@ -0,0 +1,231 @@
+import os
+import re
+import time
+import logging
+import secrets
+import threading
+from datetime import datetime
+
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from itsdangerous import Signer, BadSignature
+from sqlalchemy import delete, insert, select, update
+from werkzeug.datastructures import CallbackDict
+
+from models import db, SessionData
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session whose data lives in a server-side store; the cookie only holds its ID"""
+
+    def __init__(self, initial=None, sid=None, new=False, expires_at=None):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires_at = expires_at
+        self.modified = False
+
+
+class DatabaseSessionStore:
+    """Keeps session data in the session_data table, shared by all workers
+
+    Uses its own connection rather than the ORM session, so saving the session never
+    interferes with the request's transaction.
+    """
+
+    def load(self, sid):
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                select(SessionData.data, SessionData.expires_at).where(SessionData.sid == sid)
+            ).first()
+        if row is None or row.expires_at <= datetime.utcnow():
+            return None
+        return row.data, row.expires_at
+
+    def save(self, sid, data, expires_at):
+        with db.engine.begin() as connection:
+            result = connection.execute(
+                update(SessionData).where(SessionData.sid == sid).values(data=data, expires_at=expires_at)
+            )
+            if result.rowcount == 0:
+                connection.execute(insert(SessionData).values(sid=sid, data=data, expires_at=expires_at))
+
+    def delete(self, sid):
+        with db.engine.begin() as connection:
+            connection.execute(delete(SessionData).where(SessionData.sid == sid))
+
+    def sweep(self):
+        """Delete expired sessions, returning how many were removed"""
+        with db.engine.begin() as connection:
+            result = connection.execute(delete(SessionData).where(SessionData.expires_at <= datetime.utcnow()))
+        return result.rowcount
+
+
+class FileSessionStore:
+    """Keeps each session in its own file, for single-host deployments"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, sid):
+        return os.path.join(self.directory, f"{sid}.session")
+
+    def load(self, sid):
+        try:
+            with open(self._path(sid), encoding="utf-8") as f:
+                expires_at = datetime.fromisoformat(f.readline().strip())
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        if expires_at <= datetime.utcnow():
+            return None
+        return data, expires_at
+
+    def save(self, sid, data, expires_at):
+        # Write to a temporary file first so readers never see a half-written session
+        temporary_path = f"{self._path(sid)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            f.write(f"{expires_at.isoformat()}\n{data}")
+        os.replace(temporary_path, self._path(sid))
+
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self):
+        """Delete expired sessions, returning how many were removed"""
+        removed = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".session"):
+                continue
+            sid = name[:-len(".session")]
+            if self.load(sid) is None:
+                self.delete(sid)
+                removed += 1
+        return removed
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Flask session interface backed by a DatabaseSessionStore or FileSessionStore
+
+    The cookie carries only a signed, random session ID, so request and response
+    headers stay the same size however much is stored in the session. The expiry (and
+    the cookie with it) is only renewed once less than half of the lifetime remains,
+    so most responses don't set a cookie at all. Expired sessions are swept at most once
+    per sweep_interval seconds per worker.
+    """
+
+    SID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{20,64}$")
+
+    def __init__(self, store, sweep_interval=3600):
+        self.store = store
+        self.sweep_interval = sweep_interval
+        self._last_sweep = time.monotonic()
+        self._sweep_lock = threading.Lock()
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="edubuddy-session")
+
+    def open_session(self, app, request):
+        # Static files never use the session, so don't touch the store for them. The
+        # session is opened before the URL is matched, so go by the path, not the endpoint
+        static_path = app.static_url_path.rstrip("/") + "/" if app.static_url_path else None
+        if static_path and request.path.startswith(static_path):
+            return ServerSession()
+
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode("ascii")
+            except BadSignature:
+                sid = None
+
+            if sid and self.SID_PATTERN.match(sid):
+                try:
+                    stored = self.store.load(sid)
+                except Exception as e:
+                    logging.error(f"Error loading session: {str(e)}")
+                    stored = None
+                if stored is not None:
+                    data, expires_at = stored
+                    return ServerSession(session_json_serializer.loads(data), sid=sid, expires_at=expires_at)
+
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        if session.sid is None:
+            return
+
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        try:
+            if not session:
+                # Drop sessions that were emptied, and never store empty new ones
+                if session.modified and not session.new:
+                    self.store.delete(session.sid)
+                    response.delete_cookie(name, domain=domain, path=path)
+                return
+
+            lifetime = app.permanent_session_lifetime
+            now = datetime.utcnow()
+            needs_refresh = session.expires_at is None or session.expires_at - now < lifetime / 2
+            if session.modified or needs_refresh:
+                self.store.save(session.sid, session_json_serializer.dumps(dict(session)), now + lifetime)
+        except Exception as e:
+            logging.error(f"Error saving session: {str(e)}")
+            return
+
+        # The cookie's max age is extended along with the server-side expiry
+        if session.new or needs_refresh:
+            response.set_cookie(
+                name,
+                self._signer(app).sign(session.sid.encode("ascii")).decode("ascii"),
+                max_age=lifetime,
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                httponly=self.get_cookie_httponly(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+        self._maybe_sweep()
+
+    def _maybe_sweep(self):
+        if time.monotonic() - self._last_sweep < self.sweep_interval:
+            return
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_sweep = time.monotonic()
+            removed = self.store.sweep()
+            logging.info(f"Swept {removed} expired sessions")
+        except Exception as e:
+            logging.error(f"Error sweeping sessions: {str(e)}")
+        finally:
+            self._sweep_lock.release()
+
+
+def create_session_interface(app):
+    """Create the session interface selected by the SESSION_BACKEND environment variable
+
+    Returns None for SESSION_BACKEND=cookie, which keeps Flask's signed-cookie sessions.
+    """
+    backend = os.environ.get("SESSION_BACKEND", "database").lower()
+    sweep_interval = int(os.environ.get("SESSION_SWEEP_INTERVAL", 3600))
+
+    if backend == "database":
+        return ServerSideSessionInterface(DatabaseSessionStore(), sweep_interval)
+    if backend == "file":
+        directory = os.environ.get("SESSION_FILE_DIR", os.path.join(app.instance_path, "sessions"))
+        return ServerSideSessionInterface(FileSessionStore(directory), sweep_interval)
+    if backend == "cookie":
+        return None
+
+    raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
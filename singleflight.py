@@ -0,0 +1,334 @@
+import time
+import logging
+import threading
+from functools import partial
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, InflightCall
+from resilience import DegradedText
+
+
+class SharedFlightTable:
+    """Lock table in the database that lets one worker make a call for all workers
+
+    The first worker to insert a key's row owns the call and publishes the response
+    text into the row as it arrives, flagged when it comes from the fallback model. Once the call is done the row is kept for
+    linger seconds so workers that are still polling can read the result. A row whose
+    owner died expires after ttl seconds and can then be taken over.
+    """
+
+    def __init__(self, ttl=120, linger=10, poll_interval=0.1):
+        self.ttl = ttl
+        self.linger = linger
+        self.poll_interval = poll_interval
+
+    def acquire(self, key):
+        """Try to become the owner of a key's call"""
+        now = datetime.utcnow()
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(delete(InflightCall).where(InflightCall.key == key, InflightCall.expires_at <= now))
+                connection.execute(insert(InflightCall).values(
+                    key=key, content='', done=False, expires_at=now + timedelta(seconds=self.ttl)
+                ))
+            return True
+        except IntegrityError:
+            return False
+
+    def publish(self, key, content, done=False):
+        """Store the response text so far, or the complete response when done"""
+        expires_at = datetime.utcnow() + timedelta(seconds=self.linger if done else self.ttl)
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(InflightCall).where(InflightCall.key == key).values(
+                    content=content, done=done, degraded=isinstance(content, DegradedText), expires_at=expires_at
+                )
+            )
+
+    def release(self, key):
+        """Give up a call that failed, so that waiting workers make it themselves"""
+        with db.engine.begin() as connection:
+            connection.execute(delete(InflightCall).where(InflightCall.key == key, InflightCall.done.is_(False)))
+
+    def read(self, key):
+        """Return (content, done) of a call that is in flight or just finished, or None
+
+        Content published as DegradedText is returned as DegradedText again.
+        """
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                select(InflightCall.content, InflightCall.done, InflightCall.degraded, InflightCall.expires_at)
+                .where(InflightCall.key == key)
+            ).first()
+        if row is None or row.expires_at <= datetime.utcnow():
+            return None
+        return DegradedText(row.content) if row.degraded else row.content, row.done
+
+    def sweep(self):
+        """Delete expired rows, returning how many were removed"""
+        with db.engine.begin() as connection:
+            result = connection.execute(delete(InflightCall).where(InflightCall.expires_at <= datetime.utcnow()))
+        return result.rowcount
+
+
+class _Flight:
+    """State of one in-flight call shared by everyone waiting for it"""
+
+    def __init__(self, factory=None):
+        self.cond = threading.Condition()
+        self.factory = factory
+        self.source = None
+        self.pumping = False
+        self.chunks = []
+        self.result = None
+        self.error = None
+        self.done = False
+        self.subscribers = 0
+
+
+class SingleFlight:
+    """Coalesces identical concurrent LLM calls into a single upstream call
+
+    Calls are keyed on a fingerprint of the final prompt. While a call for a key is in
+    flight, further calls with the same key wait for it and get the same result
+    instead of calling the LLM again. Streams are shared the same way: each
+    subscriber gets every chunk from the beginning, whichever subscriber happens to
+    pull the next chunk from upstream, so the stream keeps going as long as anyone is
+    still reading it.
+
+    With a SharedFlightTable, calls are also coalesced across gunicorn workers: the
+    worker that wins the key's row makes the call, the others poll the row (at most
+    one poller per worker and key). If the owner fails, waiting workers make the call
+    themselves.
+    """
+
+    def __init__(self, shared=None, coalesced_counter=None):
+        self.shared = shared
+        self.coalesced_counter = coalesced_counter
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.counters = {'calls': 0, 'coalesced': 0, 'shared_coalesced': 0, 'shared_errors': 0}
+        self._sweep_every = 100
+
+    def _count(self, name, kind=None):
+        with self._lock:
+            self.counters[name] += 1
+        if kind and self.coalesced_counter is not None:
+            self.coalesced_counter.inc(kind=kind, scope='shared' if name == 'shared_coalesced' else 'local')
+
+    def _join(self, key, factory=None):
+        """Return (flight, leader) for a key, starting a new flight if none is in progress"""
+        with self._lock:
+            self.counters['calls'] += 1
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.subscribers += 1
+                return flight, False
+            flight = self._flights[key] = _Flight(factory)
+            flight.subscribers += 1
+            return flight, True
+
+    def _finish(self, key, flight, error=None):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        with flight.cond:
+            flight.error = error
+            flight.done = True
+            flight.pumping = False
+            flight.cond.notify_all()
+
+    def call(self, key, fn):
+        """Return fn(), or the result of an identical call that is already in flight"""
+        flight, leader = self._join(key)
+        if not leader:
+            self._count('coalesced', 'generate')
+            with flight.cond:
+                while not flight.done:
+                    flight.cond.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._shared_call(key, fn) if self.shared else fn()
+        except Exception as e:
+            self._finish(key, flight, e)
+            raise
+        self._finish(key, flight)
+        return flight.result
+
+    def stream(self, key, factory):
+        """Yield the chunks of factory(), sharing the stream with identical streams in flight"""
+        if self.shared:
+            factory = partial(self._shared_stream, key, factory)
+        flight, leader = self._join(key, factory)
+        if not leader:
+            self._count('coalesced', 'stream')
+        return self._subscribe(key, flight)
+
+    def _subscribe(self, key, flight):
+        index = 0
+        try:
+            while True:
+                with flight.cond:
+                    while index >= len(flight.chunks) and not flight.done and flight.pumping:
+                        flight.cond.wait()
+                    if index < len(flight.chunks):
+                        chunk = flight.chunks[index]
+                        index += 1
+                    elif flight.done:
+                        if flight.error is not None:
+                            raise flight.error
+                        return
+                    else:
+                        # Nobody is pulling from upstream right now, so this subscriber does
+                        flight.pumping = True
+                        chunk = None
+
+                if chunk is not None:
+                    yield chunk
+                    continue
+
+                try:
+                    if flight.source is None:
+                        flight.source = iter(flight.factory())
+                    chunk = next(flight.source)
+                except StopIteration:
+                    self._finish(key, flight)
+                    continue
+                except Exception as e:
+                    self._finish(key, flight, e)
+                    continue
+
+                with flight.cond:
+                    flight.chunks.append(chunk)
+                    flight.pumping = False
+                    flight.cond.notify_all()
+        finally:
+            with flight.cond:
+                flight.subscribers -= 1
+                abandoned = flight.subscribers == 0 and not flight.done
+            # The last subscriber disconnected mid-stream: stop the upstream call
+            if abandoned:
+                self._finish(key, flight)
+                if flight.source is not None and hasattr(flight.source, 'close'):
+                    flight.source.close()
+
+    def _maybe_sweep(self):
+        with self._lock:
+            sweep = self.counters['calls'] % self._sweep_every == 0
+        if sweep:
+            try:
+                self.shared.sweep()
+            except Exception as e:
+                logging.error(f"Error sweeping the in-flight call table: {str(e)}")
+
+    def _acquire_shared(self, key):
+        """Try to own a key's call in the shared table; errors fall back to calling locally"""
+        try:
+            self._maybe_sweep()
+            return self.shared.acquire(key)
+        except Exception as e:
+            logging.error(f"Error acquiring shared in-flight call: {str(e)}")
+            self._count('shared_errors')
+            return True
+
+    def _release_shared(self, key):
+        try:
+            self.shared.release(key)
+        except Exception as e:
+            logging.error(f"Error releasing shared in-flight call: {str(e)}")
+
+    def _publish_shared(self, key, content, done=False):
+        try:
+            self.shared.publish(key, content, done)
+        except Exception as e:
+            logging.error(f"Error publishing shared in-flight call: {str(e)}")
+            self._count('shared_errors')
+
+    def _poll_shared(self, key):
+        """Yield the growing response text of another worker's call until it is done
+
+        Stops early when the call fails or its owner disappears; the caller then
+        tries to make the call itself.
+        """
+        while True:
+            try:
+                row = self.shared.read(key)
+            except Exception as e:
+                logging.error(f"Error reading shared in-flight call: {str(e)}")
+                self._count('shared_errors')
+                return
+            if row is None:
+                return
+            content, done = row
+            yield content, done
+            if done:
+                return
+            time.sleep(self.shared.poll_interval)
+
+    def _shared_call(self, key, fn):
+        while not self._acquire_shared(key):
+            for content, done in self._poll_shared(key):
+                if done:
+                    self._count('shared_coalesced', 'generate')
+                    return content
+            # The owner failed or expired: try to take the call over
+
+        try:
+            result = fn()
+        except Exception:
+            self._release_shared(key)
+            raise
+        self._publish_shared(key, result, done=True)
+        return result
+
+    def _shared_stream(self, key, factory):
+        sent = False
+        counted = False
+        while not self._acquire_shared(key):
+            position = 0
+            for content, done in self._poll_shared(key):
+                if not counted:
+                    self._count('shared_coalesced', 'stream')
+                    counted = True
+                if len(content) > position:
+                    yield DegradedText(content[position:]) if isinstance(content, DegradedText) else content[position:]
+                    position = len(content)
+                    sent = True
+                if done:
+                    return
+            # A second answer can't be spliced onto a partly sent one, so only take over if nothing was sent
+            if sent:
+                raise RuntimeError("The shared response stream was interrupted")
+
+        chunks = []
+        last_published = time.monotonic()
+
+        def joined():
+            # A stream of the fallback model has DegradedText chunks, and the joined text is degraded too
+            text = ''.join(chunks)
+            return DegradedText(text) if chunks and isinstance(chunks[0], DegradedText) else text
+
+        try:
+            for chunk in factory():
+                chunks.append(chunk)
+                if time.monotonic() - last_published >= self.shared.poll_interval:
+                    self._publish_shared(key, joined())
+                    last_published = time.monotonic()
+                yield chunk
+        except BaseException:
+            # Also on GeneratorExit, so waiting workers don't wait for a stream nobody is reading
+            self._release_shared(key)
+            raise
+        self._publish_shared(key, joined(), done=True)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['in_flight'] = len(self._flights)
+        return stats
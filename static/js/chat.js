@@ -45,6 +45,34 @@ document.addEventListener('DOMContentLoaded', function() {
     let currentRequestController = null; // For stop generation button
     let isGenerating = false; // Flag to track if response is being generated
     let loadingChatHistory = true; // Flag to indicate we're loading chat history
+    let historyCursor = null; // Cursor for the next page of older messages, null when there are none
+    let loadingOlderMessages = false; // Flag to avoid fetching the same older page twice
+    let lastResponseHtml = null; // Server-rendered HTML of the last streamed response
+    const HISTORY_PAGE_SIZE = 50;
+    
+    // Older versions kept a snapshot of the whole chat DOM here; the server has the history
+    localStorage.removeItem('chatHistory');
+    
+    // History messages are only rendered once they come near the visible part of the chat
+    const pendingMessages = new WeakMap();
+    const lazyMessageObserver = new IntersectionObserver(entries => {
+        const isScrolledToBottom = chatMessages.scrollHeight - chatMessages.clientHeight <= chatMessages.scrollTop + 50;
+        entries.forEach(entry => {
+            if (!entry.isIntersecting) return;
+            const textElement = entry.target;
+            const pending = pendingMessages.get(textElement);
+            lazyMessageObserver.unobserve(textElement);
+            pendingMessages.delete(textElement);
+            if (pending) {
+                renderMessageText(textElement, pending.message, pending.html);
+                textElement.classList.remove('message-pending');
+            }
+        });
+        // Keep the newest message in view while the ones around it get their real height
+        if (isScrolledToBottom) {
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        }
+    }, { root: chatMessages, rootMargin: '800px 0px' });
     
     // Initialize the theme
     const savedTheme = localStorage.getItem('theme') || 'dark';
@@ -92,6 +120,11 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Scroll-to-bottom button logic
     chatMessages.addEventListener('scroll', function() {
+        // Fetch older messages when the user scrolls near the top
+        if (chatMessages.scrollTop < 200 && historyCursor && !loadingOlderMessages) {
+            loadOlderMessages();
+        }
+        
         const isScrolledToBottom = chatMessages.scrollHeight - chatMessages.clientHeight <= chatMessages.scrollTop + 50;
         
         if (isScrolledToBottom) {
@@ -288,6 +321,7 @@ document.addEventListener('DOMContentLoaded', function() {
         // Reset state variables
         isFirstMessage = true;
         currentPersona = null;
+        historyCursor = null;
         
         // Hide quick actions
         quickActions.style.display = 'none';
@@ -317,8 +351,8 @@ document.addEventListener('DOMContentLoaded', function() {
         try {
             loadingChatHistory = true;
             
-            // Fetch conversation history from the server
-            const response = await fetch('/api/history');
+            // Fetch the latest page of conversation history from the server
+            const response = await fetch(`/api/history?limit=${HISTORY_PAGE_SIZE}`);
             
             if (!response.ok) {
                 throw new Error('Failed to fetch conversation history');
@@ -330,6 +364,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 // Get the history array and persona
                 const history = data.history;
                 currentPersona = data.persona;
+                historyCursor = data.next_cursor;
                 
                 // If there's no history, we're starting a new conversation
                 if (!history || history.length === 0) {
@@ -351,10 +386,12 @@ document.addEventListener('DOMContentLoaded', function() {
                     chatMessages.appendChild(welcomeMessage);
                 }
                 
-                // Add each message to the chat
+                // Add the messages in one go; each is rendered once it's near the visible area
+                const fragment = document.createDocumentFragment();
                 history.forEach(msg => {
-                    addMessage(msg.content, msg.role, false);
+                    fragment.appendChild(createMessageElement(msg.content, msg.role, false, msg.html, true));
                 });
+                chatMessages.appendChild(fragment);
                 
                 // Update state
                 isFirstMessage = false;
@@ -373,59 +410,52 @@ document.addEventListener('DOMContentLoaded', function() {
         } catch (error) {
             console.error('Error loading chat history:', error);
             
-            // Fallback to localStorage if server fails
-            const chatHistory = localStorage.getItem('chatHistory');
-            if (chatHistory) {
-                chatMessages.innerHTML = chatHistory;
+        } finally {
+            loadingChatHistory = false;
+        }
+    }
+    
+    // Load the previous page of messages and insert it above the current ones
+    async function loadOlderMessages() {
+        loadingOlderMessages = true;
+        
+        try {
+            const params = new URLSearchParams({ limit: HISTORY_PAGE_SIZE, before: historyCursor });
+            const response = await fetch(`/api/history?${params}`);
+            
+            if (!response.ok) {
+                throw new Error('Failed to fetch older messages');
+            }
+            
+            const data = await response.json();
+            
+            if (data.success) {
+                // Insert after the welcome message, keeping the visible messages where they are
+                const welcomeMessage = chatMessages.querySelector('.message');
+                const insertBefore = welcomeMessage ? welcomeMessage.nextSibling : chatMessages.firstChild;
+                const previousHeight = chatMessages.scrollHeight;
                 
-                // Reinitialize copy buttons
-                const copyButtons = document.querySelectorAll('.copy-btn');
-                copyButtons.forEach(btn => {
-                    const messageId = btn.getAttribute('data-message-id');
-                    if (messageId !== 'welcome') {
-                        btn.setAttribute('data-message-id', messageId);
-                    }
+                const fragment = document.createDocumentFragment();
+                data.history.forEach(msg => {
+                    fragment.appendChild(createMessageElement(msg.content, msg.role, false, msg.html, true));
                 });
+                chatMessages.insertBefore(fragment, insertBefore);
                 
-                // Fallback to localStorage for persona
-                currentPersona = localStorage.getItem('persona');
-                
-                // Update state
-                isFirstMessage = false;
-                
-                // Show quick actions if persona is set
-                if (currentPersona) {
-                    updatePersonaBadge(currentPersona);
-                    showQuickActions(currentPersona);
-                }
-                
-                // Scroll to bottom
-                chatMessages.scrollTop = chatMessages.scrollHeight;
+                chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+                historyCursor = data.next_cursor;
             }
+        } catch (error) {
+            console.error('Error loading older messages:', error);
         } finally {
-            loadingChatHistory = false;
+            loadingOlderMessages = false;
         }
     }
     
-    // Save chat history to localStorage as backup
-    function saveChatHistory() {
-        localStorage.setItem('chatHistory', chatMessages.innerHTML);
-    }
-    
     // Format message using markdown-it
     function formatMessage(text) {
         try {
             // Render markdown
-            let renderedHtml = md.render(text);
-            
-            // Apply syntax highlighting to code blocks
-            setTimeout(() => {
-                document.querySelectorAll('pre code').forEach((block) => {
-                    hljs.highlightElement(block);
-                });
-            }, 0);
-            
-            return renderedHtml;
+            return md.render(text);
         } catch (error) {
             console.error('Error formatting message:', error);
             
@@ -440,15 +470,35 @@ document.addEventListener('DOMContentLoaded', function() {
         return loadingMessages[Math.floor(Math.random() * loadingMessages.length)].textContent;
     }
     
-    // Add a message to the chat
-    function addMessage(message, sender, animate = false) {
+    // Fill a message's text element, preferring the HTML rendered by the server
+    function renderMessageText(textElement, message, html = null) {
+        if (html) {
+            textElement.innerHTML = html;
+            return;
+        }
+        textElement.innerHTML = formatMessage(message);
+        highlightCodeBlocks(textElement);
+    }
+    
+    // Apply syntax highlighting to a message's code blocks (server-rendered ones already are)
+    function highlightCodeBlocks(element) {
+        element.querySelectorAll('pre:not(.highlight) > code').forEach(block => {
+            hljs.highlightElement(block);
+        });
+    }
+    
+    // Create the element for a chat message
+    //
+    // html is the server's rendering of the message, if there is one. With lazy, the
+    // text is only rendered once the message scrolls near the visible part of the chat.
+    function createMessageElement(message, sender, animate = false, html = null, lazy = false) {
         messageCounter++;
         const messageId = `msg-${Date.now()}-${messageCounter}`;
         const messageDiv = document.createElement('div');
         messageDiv.classList.add('message', `${sender}-message`);
         
         const iconClass = sender === 'user' ? 'fas fa-user' : 'fas fa-graduation-cap';
-        let formattedMessage = formatMessage(message);
+        const formattedMessage = lazy ? '' : (html || formatMessage(message));
         
         // Create the message HTML structure with copy button
         messageDiv.innerHTML = `
@@ -456,7 +506,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 <i class="${iconClass}"></i>
             </div>
             <div class="message-content">
-                <div class="message-text" id="message-${messageId}">
+                <div class="message-text${lazy ? ' message-pending' : ''}" id="message-${messageId}">
                     ${animate ? '<span class="typing-text">' + formattedMessage + '</span>' : formattedMessage}
                 </div>
                 ${sender === 'assistant' ? `
@@ -468,14 +518,25 @@ document.addEventListener('DOMContentLoaded', function() {
             </div>
         `;
         
+        const textElement = messageDiv.querySelector('.message-text');
+        if (lazy) {
+            pendingMessages.set(textElement, { message, html });
+            lazyMessageObserver.observe(textElement);
+        } else if (!html && !animate) {
+            highlightCodeBlocks(textElement);
+        }
+        
+        return messageDiv;
+    }
+    
+    // Add a message to the chat
+    function addMessage(message, sender, animate = false) {
+        const messageDiv = createMessageElement(message, sender, animate);
         chatMessages.appendChild(messageDiv);
         
         // Scroll to bottom
         chatMessages.scrollTop = chatMessages.scrollHeight;
         
-        // Save to localStorage
-        saveChatHistory();
-        
         // If this is the first user message and we have a persona, show quick actions
         if (sender === 'user' && isFirstMessage && currentPersona) {
             isFirstMessage = false;
@@ -485,6 +546,7 @@ document.addEventListener('DOMContentLoaded', function() {
         // If animation is requested and this is an assistant message, animate typing
         if (animate && sender === 'assistant') {
             const textElement = messageDiv.querySelector('.typing-text');
+            const formattedMessage = textElement ? textElement.innerHTML : '';
             
             if (textElement) {
                 // Hide the text initially
@@ -504,15 +566,7 @@ document.addEventListener('DOMContentLoaded', function() {
                             parentElement.innerHTML = formattedMessage;
                             
                             // Re-highlight code blocks
-                            const codeBlocks = parentElement.querySelectorAll('pre code');
-                            if (codeBlocks.length > 0) {
-                                codeBlocks.forEach(block => {
-                                    hljs.highlightElement(block);
-                                });
-                            }
-                            
-                            // Update localStorage after animation completes
-                            saveChatHistory();
+                            highlightCodeBlocks(parentElement);
                         }
                     }
                 }).go();
@@ -550,8 +604,11 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
-    // Send message to backend API
-    async function sendMessage(message, persona = null, action = null) {
+    // Send message to backend API and stream the response as it's generated
+    async function sendMessage(message, persona = null, action = null, onChunk = null) {
+        let responseText = '';
+        lastResponseHtml = null;
+        
         try {
             // Create an AbortController for this request
             currentRequestController = new AbortController();
@@ -567,7 +624,7 @@ document.addEventListener('DOMContentLoaded', function() {
             if (persona) payload.persona = persona;
             if (action) payload.action = action;
             
-            const response = await fetch('/api/chat', {
+            const response = await fetch('/api/chat/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
@@ -576,28 +633,61 @@ document.addEventListener('DOMContentLoaded', function() {
                 signal: signal // Add signal to allow request cancellation
             });
             
-            // Reset generating state
-            isGenerating = false;
-            stopGenerationBtn.style.display = 'none';
-            
             if (!response.ok) {
                 const errorData = await response.json();
                 throw new Error(errorData.error || 'Failed to get response');
             }
             
-            const data = await response.json();
+            // Read server-sent events from the response body as they arrive
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
             
-            // Update persona if returned from server
-            if (data.persona && data.persona !== currentPersona) {
-                currentPersona = data.persona;
-                localStorage.setItem('persona', currentPersona);
-                updatePersonaBadge(currentPersona);
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                
+                buffer += decoder.decode(value, { stream: true });
+                
+                // Events are separated by a blank line; keep any incomplete event in the buffer
+                const events = buffer.split('\n\n');
+                buffer = events.pop();
+                
+                for (const event of events) {
+                    const data = event.split('\n')
+                        .filter(line => line.startsWith('data: '))
+                        .map(line => line.slice(6))
+                        .join('\n');
+                    if (!data) continue;
+                    
+                    const eventData = JSON.parse(data);
+                    
+                    if (eventData.type === 'chunk') {
+                        responseText += eventData.text;
+                        if (onChunk) onChunk(responseText);
+                    } else if (eventData.type === 'done') {
+                        lastResponseHtml = eventData.html || null;
+                        
+                        // Update persona if returned from server
+                        if (eventData.persona && eventData.persona !== currentPersona) {
+                            currentPersona = eventData.persona;
+                            localStorage.setItem('persona', currentPersona);
+                            updatePersonaBadge(currentPersona);
+                        }
+                    } else if (eventData.type === 'error') {
+                        throw new Error(eventData.error);
+                    }
+                }
             }
             
+            // Reset generating state
+            isGenerating = false;
+            stopGenerationBtn.style.display = 'none';
+            
             // Detect subject from the message and response to show context-based actions
-            detectSubjectAndUpdateActions(message, data.response);
+            detectSubjectAndUpdateActions(message, responseText);
             
-            return data.response;
+            return responseText;
         } catch (error) {
             // Reset generating state
             isGenerating = false;
@@ -605,7 +695,7 @@ document.addEventListener('DOMContentLoaded', function() {
             
             // Check if error was caused by abort (user clicked "Stop Generating")
             if (error.name === 'AbortError') {
-                return "Generation stopped by user.";
+                return responseText || "Generation stopped by user.";
             }
             
             console.error('Error sending message:', error);
@@ -613,6 +703,37 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    // Send a message and render the assistant's response chunk by chunk
+    async function streamAssistantResponse(message, persona, action, typingIndicator) {
+        let textElement = null;
+        
+        const response = await sendMessage(message, persona, action, responseText => {
+            // Replace the typing indicator with the assistant message on the first chunk
+            if (!textElement) {
+                removeTypingIndicator(typingIndicator);
+                const messageDiv = addMessage('', 'assistant');
+                textElement = messageDiv.querySelector('.message-text');
+            }
+            
+            const isScrolledToBottom = chatMessages.scrollHeight - chatMessages.clientHeight <= chatMessages.scrollTop + 50;
+            textElement.innerHTML = md.render(responseText);
+            if (isScrolledToBottom) {
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            }
+        });
+        
+        removeTypingIndicator(typingIndicator);
+        
+        if (!textElement) {
+            // Nothing was streamed, e.g. the request was stopped before the first chunk
+            addMessage(response, 'assistant');
+            return;
+        }
+        
+        // Final render once the response is complete, with the server's highlighted HTML when available
+        renderMessageText(textElement, response, lastResponseHtml);
+    }
+    
     // Detect subject from text and update context-based action buttons
     function detectSubjectAndUpdateActions(userMessage, aiResponse) {
         if (!subjectActionTemplates) return;
@@ -670,14 +791,8 @@ document.addEventListener('DOMContentLoaded', function() {
         const typingIndicator = addTypingIndicator();
         
         try {
-            // Send message to backend with action
-            const response = await sendMessage(message, persona, action);
-            
-            // Remove typing indicator
-            removeTypingIndicator(typingIndicator);
-            
-            // Add assistant response to chat with typing animation
-            addMessage(response, 'assistant', true);
+            // Send message to backend with action and stream the response into the chat
+            await streamAssistantResponse(message, persona, action, typingIndicator);
         } catch (error) {
             // Remove typing indicator
             removeTypingIndicator(typingIndicator);
@@ -727,14 +842,8 @@ document.addEventListener('DOMContentLoaded', function() {
         const typingIndicator = addTypingIndicator();
         
         try {
-            // Send message to backend and get response
-            const response = await sendMessage(message);
-            
-            // Remove typing indicator
-            removeTypingIndicator(typingIndicator);
-            
-            // Add assistant response to chat with typing animation
-            addMessage(response, 'assistant', true);
+            // Send message to backend and stream the response into the chat
+            await streamAssistantResponse(message, null, null, typingIndicator);
         } catch (error) {
             // Remove typing indicator
             removeTypingIndicator(typingIndicator);
@@ -754,9 +863,6 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
     
-    // Load chat history when page loads
-    loadChatHistory();
-    
     // Focus input on page load if persona selection is not showing
     if (personaSelection.style.display !== 'block') {
         userInput.focus();
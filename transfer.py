@@ -0,0 +1,344 @@
+import json
+import zlib
+from datetime import datetime
+
+from sqlalchemy import bindparam, insert, select, text, update
+
+from models import Conversation, Message
+
+FORMAT_VERSION = 1
+
+# Columns left out of exports: the rendered HTML is a cache, rebuilt when history is read
+EXCLUDED_MESSAGE_COLUMNS = {'content_html'}
+
+
+class ImportValidationError(ValueError):
+    """An export file is malformed or inconsistent; nothing of it is imported"""
+
+    def __init__(self, line_number, message):
+        super().__init__(f"Line {line_number}: {message}")
+        self.line_number = line_number
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _line(record):
+    return json.dumps(record, default=_json_default) + "\n"
+
+
+def export_lines(connection, condition=None, chunk_size=1000, counts=None):
+    """Yield the conversations matching condition, and their messages, as NDJSON lines
+
+    The first line is a header and the last one a trailer with the number of
+    conversations and messages, so truncated files are detected on import. Each
+    conversation line is followed by the lines of its messages, in id order:
+
+        {"type": "export", "version": 1, "exported_at": "..."}
+        {"type": "conversation", "id": 7, "session_id": "...", "persona": "code", ...}
+        {"type": "message", "id": 81, "conversation_id": 7, "role": "user", ...}
+        {"type": "end", "conversations": 1, "messages": 1}
+
+    Conversations and messages are read with two server-side cursors (yield_per)
+    walked side by side, so memory use doesn't depend on the size of the export.
+    counts, if given, is filled with the numbers of conversations and messages.
+    """
+    conversation_table = Conversation.__table__
+    message_table = Message.__table__
+    message_columns = [column for column in message_table.c if column.name not in EXCLUDED_MESSAGE_COLUMNS]
+
+    conversation_query = select(conversation_table).order_by(conversation_table.c.id)
+    message_query = select(*message_columns).order_by(message_table.c.conversation_id, message_table.c.id)
+    if condition is not None:
+        conversation_query = conversation_query.where(condition)
+        message_query = message_query.where(
+            message_table.c.conversation_id.in_(select(conversation_table.c.id).where(condition))
+        )
+
+    counts = counts if counts is not None else {}
+    counts.update(conversations=0, messages=0)
+    streaming = connection.execution_options(yield_per=chunk_size)
+
+    yield _line({'type': 'export', 'version': FORMAT_VERSION, 'exported_at': datetime.utcnow()})
+    messages = iter(streaming.execute(message_query).mappings())
+    message = next(messages, None)
+    for conversation in streaming.execute(conversation_query).mappings():
+        yield _line({'type': 'conversation', **conversation})
+        counts['conversations'] += 1
+        # Both cursors are ordered by conversation id, so this is a merge join
+        while message is not None and message['conversation_id'] <= conversation['id']:
+            if message['conversation_id'] == conversation['id']:
+                yield _line({'type': 'message', **message})
+                counts['messages'] += 1
+            message = next(messages, None)
+    yield _line({'type': 'end', 'conversations': counts['conversations'], 'messages': counts['messages']})
+
+
+def gzip_chunks(lines, level=6, buffer_size=65536):
+    """Gzip-compress an iterable of text lines incrementally, yielding bytes"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+    buffered = []
+    size = 0
+    for line in lines:
+        data = line.encode("utf-8")
+        buffered.append(data)
+        size += len(data)
+        if size >= buffer_size:
+            chunk = compressor.compress(b"".join(buffered))
+            buffered, size = [], 0
+            if chunk:
+                yield chunk
+    yield compressor.compress(b"".join(buffered)) + compressor.flush()
+
+
+def _parse_timestamp(value, line_number, field):
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ImportValidationError(line_number, f"invalid {field}: {value!r}")
+
+
+class ConversationImporter:
+    """Bulk-imports an NDJSON export (see export_lines) into the database
+
+    Lines are validated as they are read:
+
+    - ids are integers, conversation ids and session IDs are unique in the file
+    - a conversation's updated_at isn't before its created_at
+    - every message belongs to a conversation that came earlier in the file, and a
+      conversation's messages come in increasing id and non-decreasing timestamp order
+    - a conversation's summary_until refers to one of its own messages
+    - the trailer is present and its counts match, so a truncated file is rejected
+
+    Rows are inserted batch_size at a time with executemany inserts, all in the
+    caller's transaction, so an invalid file leaves nothing behind. Conversations
+    whose session ID (or, with preserve_ids, id) already exists are skipped together
+    with their messages. Without preserve_ids the database assigns new ids and
+    conversation_id and summary_until are mapped to them.
+
+    Memory use grows only with the number of conversations (their id mapping), not
+    with the number or size of messages.
+    """
+
+    def __init__(self, connection, batch_size=1000, preserve_ids=False):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.preserve_ids = preserve_ids
+        self.conversation_ids = {}  # exported id -> new id, or None if skipped
+        self._last_message = {}  # exported conversation id -> (message id, timestamp)
+        self._session_ids = set()
+        self._summary_until = {}  # exported conversation id -> summary_until whose message hasn't come yet
+        self._summary_updates = []
+        self._conversations = []
+        self._messages = []
+        self.counts = {'conversations': 0, 'messages': 0, 'skipped_conversations': 0, 'skipped_messages': 0}
+        self._seen = {'conversations': 0, 'messages': 0}
+        self._header = False
+        self._ended = False
+
+    def import_lines(self, lines):
+        """Import every line of an export; returns the counts of imported and skipped rows"""
+        line_number = 0
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            if self._ended:
+                raise ImportValidationError(line_number, "data after the end of the export")
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ImportValidationError(line_number, "not valid JSON")
+            if not isinstance(record, dict):
+                raise ImportValidationError(line_number, "not a JSON object")
+
+            kind = record.get('type')
+            if not self._header:
+                if kind != 'export' or record.get('version') != FORMAT_VERSION:
+                    raise ImportValidationError(line_number, f"expected an export header of version {FORMAT_VERSION}")
+                self._header = True
+            elif kind == 'conversation':
+                self._add_conversation(record, line_number)
+            elif kind == 'message':
+                self._add_message(record, line_number)
+            elif kind == 'end':
+                self._end(record, line_number)
+            else:
+                raise ImportValidationError(line_number, f"unknown record type {kind!r}")
+
+            if len(self._messages) >= self.batch_size or len(self._conversations) >= self.batch_size:
+                self.flush()
+
+        if not self._ended:
+            raise ImportValidationError(line_number, "the export is truncated (no end line)")
+        self.flush()
+        self._finish()
+        return self.counts
+
+    def _add_conversation(self, record, line_number):
+        conversation_id = record.get('id')
+        session_id = record.get('session_id')
+        if not isinstance(conversation_id, int) or conversation_id in self.conversation_ids:
+            raise ImportValidationError(line_number, f"missing or duplicate conversation id {conversation_id!r}")
+        if not isinstance(session_id, str) or not session_id or session_id in self._session_ids:
+            raise ImportValidationError(line_number, f"missing or duplicate session_id {session_id!r}")
+        created_at = _parse_timestamp(record.get('created_at'), line_number, 'created_at')
+        updated_at = _parse_timestamp(record.get('updated_at'), line_number, 'updated_at')
+        if created_at and updated_at and updated_at < created_at:
+            raise ImportValidationError(line_number, "updated_at is before created_at")
+        summary_until = record.get('summary_until')
+        if summary_until is not None and not isinstance(summary_until, int):
+            raise ImportValidationError(line_number, f"invalid summary_until {summary_until!r}")
+
+        self._session_ids.add(session_id)
+        self.conversation_ids[conversation_id] = None  # Known, new id assigned on flush
+        self._seen['conversations'] += 1
+        if summary_until is not None:
+            self._summary_until[conversation_id] = summary_until
+        self._conversations.append({
+            'id': conversation_id,
+            'session_id': session_id,
+            'persona': record.get('persona'),
+            'summary': record.get('summary'),
+            # Mapped once the message it refers to has been imported
+            'summary_until': summary_until if self.preserve_ids else None,
+            'created_at': created_at,
+            'updated_at': updated_at,
+        })
+
+    def _add_message(self, record, line_number):
+        message_id = record.get('id')
+        conversation_id = record.get('conversation_id')
+        if conversation_id not in self.conversation_ids:
+            raise ImportValidationError(line_number, f"message of unknown conversation {conversation_id!r}")
+        if not isinstance(message_id, int):
+            raise ImportValidationError(line_number, f"invalid message id {message_id!r}")
+        if record.get('role') not in ('user', 'assistant') or not isinstance(record.get('content'), str):
+            raise ImportValidationError(line_number, "a message needs a role of user or assistant and a content string")
+        timestamp = _parse_timestamp(record.get('timestamp'), line_number, 'timestamp')
+
+        last = self._last_message.get(conversation_id)
+        if last is not None:
+            last_id, last_timestamp = last
+            if message_id <= last_id:
+                raise ImportValidationError(line_number, f"message id {message_id} isn't after {last_id}")
+            if timestamp and last_timestamp and timestamp < last_timestamp:
+                raise ImportValidationError(line_number, f"message {message_id} is older than the one before it")
+        self._last_message[conversation_id] = (message_id, timestamp)
+
+        self._seen['messages'] += 1
+        summarized = self._summary_until.get(conversation_id) == message_id
+        if summarized:
+            del self._summary_until[conversation_id]
+        self._messages.append({
+            'id': message_id,
+            'conversation_id': conversation_id,
+            'role': record['role'],
+            'content': record['content'],
+            'timestamp': timestamp,
+            # The conversation's summary_until is this message
+            'summarized': summarized,
+        })
+
+    def _end(self, record, line_number):
+        if record.get('conversations') != self._seen['conversations'] or record.get('messages') != self._seen['messages']:
+            raise ImportValidationError(
+                line_number,
+                f"the end line counts {record.get('conversations')} conversations and {record.get('messages')} "
+                f"messages, but the file has {self._seen['conversations']} and {self._seen['messages']}"
+            )
+        self._ended = True
+
+    def _existing(self, conversations):
+        """Exported ids of the conversations that are already in the database"""
+        session_ids = [row['session_id'] for row in conversations]
+        existing_sessions = set(self.connection.execute(
+            select(Conversation.session_id).where(Conversation.session_id.in_(session_ids))
+        ).scalars())
+        existing = {row['id'] for row in conversations if row['session_id'] in existing_sessions}
+        if self.preserve_ids:
+            existing |= set(self.connection.execute(
+                select(Conversation.id).where(Conversation.id.in_([row['id'] for row in conversations]))
+            ).scalars())
+        return existing
+
+    def flush(self):
+        """Insert the buffered conversations, then the buffered messages"""
+        if self._conversations:
+            existing = self._existing(self._conversations)
+            new_rows = [row for row in self._conversations if row['id'] not in existing]
+            self.counts['skipped_conversations'] += len(self._conversations) - len(new_rows)
+
+            if new_rows:
+                if self.preserve_ids:
+                    self.connection.execute(insert(Conversation), new_rows)
+                    new_ids = [row['id'] for row in new_rows]
+                else:
+                    new_ids = self.connection.execute(
+                        insert(Conversation).returning(Conversation.id, sort_by_parameter_order=True),
+                        [{key: value for key, value in row.items() if key != 'id'} for row in new_rows]
+                    ).scalars().all()
+                for row, new_id in zip(new_rows, new_ids):
+                    self.conversation_ids[row['id']] = new_id
+            self.counts['conversations'] += len(new_rows)
+            self._conversations = []
+
+        if self._messages:
+            rows = []
+            summarized = []
+            for row in self._messages:
+                new_conversation_id = self.conversation_ids[row['conversation_id']]
+                if new_conversation_id is None:
+                    self.counts['skipped_messages'] += 1
+                    continue
+                summarized.append(row.pop('summarized'))
+                rows.append(dict(row, conversation_id=new_conversation_id))
+
+            if rows:
+                if self.preserve_ids:
+                    self.connection.execute(insert(Message), rows)
+                else:
+                    new_ids = self.connection.execute(
+                        insert(Message).returning(Message.id, sort_by_parameter_order=True),
+                        [{key: value for key, value in row.items() if key != 'id'} for row in rows]
+                    ).scalars().all()
+                    self._summary_updates += [
+                        {'conversation_id': row['conversation_id'], 'new_summary_until': new_id}
+                        for row, new_id, is_summarized in zip(rows, new_ids, summarized) if is_summarized
+                    ]
+            self.counts['messages'] += len(rows)
+            self._messages = []
+
+        if self._summary_updates:
+            self.connection.execute(
+                update(Conversation)
+                .where(Conversation.id == bindparam('conversation_id'))
+                .values(summary_until=bindparam('new_summary_until')),
+                self._summary_updates
+            )
+            self._summary_updates = []
+
+    def _finish(self):
+        # A summary_until whose message wasn't in the file can't be mapped, so drop the summary
+        missing = [
+            self.conversation_ids[conversation_id]
+            for conversation_id in self._summary_until
+            if self.conversation_ids[conversation_id] is not None
+        ]
+        if missing:
+            self.connection.execute(
+                update(Conversation).where(Conversation.id.in_(missing)).values(summary=None, summary_until=None)
+            )
+        self.counts['summaries_dropped'] = len(missing)
+
+        # Explicit ids leave Postgres sequences behind
+        if self.preserve_ids and self.connection.dialect.name == 'postgresql':
+            for table in ('conversation', 'message'):
+                self.connection.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT coalesce(max(id), 1) FROM {table}))"
+                ))
+
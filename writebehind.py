@@ -0,0 +1,260 @@
+import os
+import atexit
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy import bindparam, insert, update
+from sqlalchemy.exc import DataError, IntegrityError
+
+from models import db, Conversation, Message
+
+
+class WriteBehindWriter:
+    """Queues new chat messages in memory and writes them to the database in batches
+
+    A background thread flushes the queue every flush_interval seconds, or as soon as
+    batch_size messages are waiting, with one multi-row INSERT for the messages and
+    one UPDATE per conversation for updated_at. Requests therefore don't wait for a
+    commit, and concurrent requests don't contend for the conversation row.
+
+    Queued messages are visible to this worker through pending(), so a user's next
+    request sees its own messages before they reach the database; other workers see
+    them after the next flush. A message can be held back while it is still being
+    written (e.g. a streamed answer) and is flushed once finish() is called; the
+    messages queued after it wait for it to keep the conversation in order.
+
+    The queue is flushed on graceful shutdown (close(), also registered with atexit).
+    Messages still queued when a worker is killed are lost, which is the price of
+    not committing them synchronously. If the queue grows past max_pending, callers
+    flush it themselves, which slows them down instead of growing without bound.
+    A batch the database refuses is retried row by row, and rows it rejects (e.g.
+    for a deleted conversation) are logged and dropped, so they can't block the rest.
+    """
+
+    def __init__(self, app, flush_interval=0.2, batch_size=500, max_pending=5000):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending = {}  # conversation ID -> list of queued entries, oldest first
+        self._versions = {}  # conversation ID -> count of changes to its queued entries
+        self._count = 0
+        self._lock = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        self.stats_counters = {'queued': 0, 'flushed': 0, 'flushes': 0, 'errors': 0, 'dropped': 0}
+        atexit.register(self.close)
+
+    def _ensure_thread(self):
+        # Started on first use, and again after a fork, since threads don't survive forking
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, conversation_id, entries, hold_last=False):
+        """Queue entries (dicts with role, content, timestamp and optionally html) for a conversation
+
+        With hold_last the last entry isn't flushed until finish() is called for it;
+        until then its content can still change.
+        """
+        if hold_last:
+            entries[-1]['held'] = True
+
+        with self._lock:
+            self._ensure_thread()
+            self._pending.setdefault(conversation_id, []).extend(entries)
+            self._versions[conversation_id] = self._versions.get(conversation_id, 0) + 1
+            self._count += len(entries)
+            self.stats_counters['queued'] += len(entries)
+            if self._count >= self.batch_size:
+                self._lock.notify()
+            # After close() there is no background thread left to write them
+            flush_now = self._count >= self.max_pending or self._closed
+
+        if flush_now:
+            self.flush()
+        return entries
+
+    def update(self, conversation_id, entry, content):
+        """Change the content of a held entry that hasn't been flushed yet"""
+        with self._lock:
+            entry['content'] = content
+            self._versions[conversation_id] = self._versions.get(conversation_id, 0) + 1
+
+    def finish(self, conversation_id, entry):
+        """Release a held entry so it is flushed with the next batch"""
+        with self._lock:
+            entry.pop('held', None)
+            self._versions[conversation_id] = self._versions.get(conversation_id, 0) + 1
+
+    def pending(self, conversation_id):
+        """Copies of the entries queued for a conversation, oldest first"""
+        with self._lock:
+            return [dict(entry) for entry in self._pending.get(conversation_id, ())]
+
+    def version(self, conversation_id):
+        """Counter that changes whenever the queued entries of a conversation do"""
+        with self._lock:
+            return self._versions.get(conversation_id, 0)
+
+    def discard(self, conversation_id):
+        """Drop the queued entries of a conversation, e.g. when its history is deleted"""
+        # Wait for a flush in progress so it can't write the entries after they were discarded
+        with self._flush_lock, self._lock:
+            dropped = self._pending.pop(conversation_id, [])
+            self._count -= len(dropped)
+            self._versions[conversation_id] = self._versions.get(conversation_id, 0) + 1
+
+    def _take_batch(self, include_held, conversation_id=None):
+        """Remove up to batch_size flushable entries (of one conversation, if given) from the queue"""
+        batch = {}
+        taken = 0
+        with self._lock:
+            conversation_ids = [conversation_id] if conversation_id is not None else list(self._pending)
+            for conversation_id in conversation_ids:
+                entries = self._pending.get(conversation_id, [])
+                ready = 0
+                while ready < len(entries) and taken < self.batch_size:
+                    if entries[ready].get('held') and not include_held:
+                        break
+                    ready += 1
+                    taken += 1
+                if ready:
+                    batch[conversation_id] = [dict(entry) for entry in entries[:ready]]
+                if taken >= self.batch_size:
+                    break
+        return batch
+
+    def _remove_flushed(self, counts):
+        """Remove the first counts[conversation ID] entries of each conversation from the queue"""
+        with self._lock:
+            for conversation_id, flushed in counts.items():
+                entries = self._pending.get(conversation_id)
+                if not entries or not flushed:
+                    continue
+                del entries[:flushed]
+                if not entries:
+                    del self._pending[conversation_id]
+                self._count -= flushed
+                self._versions[conversation_id] = self._versions.get(conversation_id, 0) + 1
+
+    def _insert(self, batch, now):
+        """Insert a batch of entries and bump the updated_at of their conversations"""
+        rows = [
+            {
+                'conversation_id': conversation_id,
+                'role': entry['role'],
+                'content': entry['content'],
+                'content_html': entry.get('html'),
+                'timestamp': entry['timestamp']
+            }
+            for conversation_id, entries in batch.items()
+            for entry in entries
+        ]
+        with self.app.app_context(), db.engine.begin() as connection:
+            connection.execute(insert(Message.__table__), rows)
+            # One coalesced updated_at bump per conversation, however many messages it got
+            connection.execute(
+                update(Conversation.__table__)
+                .where(Conversation.__table__.c.id == bindparam('conversation_id'))
+                .values(updated_at=bindparam('new_updated_at')),
+                [{'conversation_id': conversation_id, 'new_updated_at': now} for conversation_id in batch]
+            )
+        return len(rows)
+
+    def _insert_one_by_one(self, batch, now):
+        """Retry a failed batch one entry at a time, dropping entries the database rejects
+
+        Returns (done, written): the number of leading entries per conversation that
+        were written or dropped, and how many were written. Any other error (the
+        database is down) stops the retry, leaving the rest queued.
+        """
+        done = {}
+        written = 0
+        for conversation_id, entries in batch.items():
+            for entry in entries:
+                try:
+                    written += self._insert({conversation_id: [entry]}, now)
+                except (IntegrityError, DataError) as e:
+                    logging.error(f"Dropping a queued message of conversation {conversation_id}: {str(e)}")
+                    with self._lock:
+                        self.stats_counters['dropped'] += 1
+                except Exception:
+                    return done, written
+                done[conversation_id] = done.get(conversation_id, 0) + 1
+        return done, written
+
+    def flush(self, include_held=False, conversation_id=None):
+        """Write queued entries to the database until nothing flushable is left
+
+        With conversation_id only that conversation's entries are written. Held
+        entries are only written with include_held, which is meant for shutdown: a
+        held entry is removed from the queue once written, so later update() and
+        finish() calls for it would be lost.
+
+        Returns the number of messages written. On a database error the entries stay
+        queued and are retried by the next flush.
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                batch = self._take_batch(include_held, conversation_id)
+                if not batch:
+                    return written
+
+                now = datetime.utcnow()
+                try:
+                    flushed = self._insert(batch, now)
+                    done = {conversation_id: len(entries) for conversation_id, entries in batch.items()}
+                except Exception as e:
+                    count = sum(len(entries) for entries in batch.values())
+                    logging.error(f"Error flushing {count} queued messages: {str(e)}")
+                    with self._lock:
+                        self.stats_counters['errors'] += 1
+                    done, flushed = self._insert_one_by_one(batch, now)
+
+                self._remove_flushed(done)
+                written += flushed
+                with self._lock:
+                    self.stats_counters['flushed'] += flushed
+                    self.stats_counters['flushes'] += 1 if flushed else 0
+                # Entries left over from a failed batch are retried by the next flush
+                if sum(done.values()) < sum(len(entries) for entries in batch.values()):
+                    return written
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._closed and self._count < self.batch_size:
+                    self._lock.wait(self.flush_interval)
+                if self._closed:
+                    return
+            self.flush()
+
+    def close(self):
+        """Stop the background thread and write everything still queued, held entries included"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._lock.notify_all()
+            thread = self._thread if self._pid == os.getpid() else None
+
+        if thread is not None:
+            thread.join(timeout=10)
+        self.flush(include_held=True)
+
+        with self._lock:
+            if self._count:
+                logging.error(f"{self._count} queued messages could not be written at shutdown")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.stats_counters)
+            stats['pending'] = self._count
+        return stats